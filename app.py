@@ -105,6 +105,15 @@ class DojangApplication(object):
 
         self.settings['__dojang_global__'][key] = value
 
+    def register_cache_stats(self, pattern='/_cache/stats'):
+        """Serve the cache statistics as JSON at ``pattern``::
+
+            application.register_cache_stats('/_cache/stats')
+
+        """
+        from .web import CacheStatsHandler
+        self.add_handler((pattern, CacheStatsHandler))
+
     def register_api(self, app, host_pattern=None):
         if host_pattern:
             if not host_pattern.endswith("$"):
@@ -0,0 +1,560 @@
+"""Non-blocking cache clients for the IOLoop.
+
+Every command returns a :class:`tornado.concurrent.Future`, use them in
+coroutines::
+
+    from dojang.asynccache import async_complex_cache
+
+    @gen.coroutine
+    def get(self):
+        value = yield async_complex_cache.get('key')
+
+When redis or memcache is not configured, the clients wrap the in-process
+caches of :mod:`dojang.cache` so the same code runs without a server.
+"""
+
+from collections import deque, OrderedDict
+import binascii
+import cPickle
+import functools
+import socket
+
+from tornado import gen
+from tornado.concurrent import Future, is_future
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.options import options
+
+from .cache import (_Cache, _CacheListLookup, _dumps, complex_cache,
+                    simple_cache)
+from .serializer import loads as deserialize
+from .sharding import ShardedRedis
+from .shmcache import SharedMemoryCache
+
+
+__all__ = ['AsyncRedis', 'AsyncShardedRedis', 'AsyncMemcache',
+           'AsyncShardedMemcache', 'AsyncCacheAdapter',
+           'async_complex_cache', 'async_simple_cache', 'async_autocached',
+           'async_autocache_get', 'async_autocache_set',
+           'async_autocache_mget', 'async_get_cache_list']
+
+
+class CacheResponseError(Exception):
+    pass
+
+
+class _AsyncClient(object):
+    """One connection, commands are written as soon as they are issued and
+    replies are matched to them in order, so concurrent commands are
+    pipelined for free.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self._stream = None
+        self._connecting = None
+        self._pending = deque()
+        #: the stream whose replies are read
+        self._reading = None
+
+    @gen.coroutine
+    def _connect(self):
+        stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        yield stream.connect((self.host, self.port))
+        stream.set_close_callback(functools.partial(self._on_stream_close,
+                                                    stream))
+        self._stream = stream
+        yield self._on_connect()
+
+    def _on_stream_close(self, stream):
+        #: the server closed an idle connection, the next command reconnects
+        if stream is self._stream:
+            self._close(stream.error or StreamClosedError())
+
+    @gen.coroutine
+    def _get_stream(self):
+        if self._stream is not None and self._stream.closed():
+            self._close(StreamClosedError())
+        if self._stream is None:
+            if self._connecting is None:
+                self._connecting = self._connect()
+            try:
+                yield self._connecting
+            finally:
+                self._connecting = None
+        raise gen.Return(self._stream)
+
+    def _on_connect(self):
+        future = Future()
+        future.set_result(None)
+        return future
+
+    @gen.coroutine
+    def _send(self, payload, parser):
+        stream = yield self._get_stream()
+        try:
+            stream.write(payload)
+        except StreamClosedError:
+            #: closed before its close callback ran, connect again once
+            self._close(StreamClosedError())
+            stream = yield self._get_stream()
+            stream.write(payload)
+        future = Future()
+        self._pending.append((future, parser))
+        if self._reading is not stream:
+            self._read_replies()
+        result = yield future
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _read_replies(self):
+        """Read the replies of the current stream, until it is replaced.
+        """
+        stream = self._reading = self._stream
+        try:
+            while self._pending and self._stream is stream:
+                future, parser = self._pending[0]
+                try:
+                    reply = yield parser()
+                except StreamClosedError as e:
+                    if self._stream is stream:
+                        self._close(e)
+                    return
+                self._pending.popleft()
+                if isinstance(reply, CacheResponseError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        finally:
+            if self._reading is stream:
+                self._reading = None
+
+    def _close(self, error):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        while self._pending:
+            future, parser = self._pending.popleft()
+            future.set_exception(error)
+
+    def close(self):
+        self._close(StreamClosedError())
+
+
+def _encode_command(args):
+    output = ['*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, str):
+            arg = str(arg)
+        output.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(output)
+
+
+class AsyncRedis(_AsyncClient):
+    """Non-blocking redis client, method names and replies follow
+    redis-py.
+    """
+    def __init__(self, host='localhost', port=6379, db=0):
+        super(AsyncRedis, self).__init__(host, port)
+        self.db = db
+
+    @gen.coroutine
+    def _on_connect(self):
+        if self.db:
+            payload = _encode_command(('SELECT', self.db))
+            self._pending.append((Future(), self._read_reply))
+            self._stream.write(payload)
+            yield self._read_replies()
+
+    @gen.coroutine
+    def _read_reply(self):
+        line = yield self._stream.read_until('\r\n')
+        kind, rest = line[0], line[1:-2]
+        if kind == '+':
+            raise gen.Return(rest)
+        if kind == '-':
+            raise gen.Return(CacheResponseError(rest))
+        if kind == ':':
+            raise gen.Return(int(rest))
+        if kind == '$':
+            length = int(rest)
+            if length == -1:
+                raise gen.Return(None)
+            data = yield self._stream.read_bytes(length + 2)
+            raise gen.Return(data[:-2])
+        if kind == '*':
+            length = int(rest)
+            if length == -1:
+                raise gen.Return(None)
+            items = []
+            for i in range(length):
+                item = yield self._read_reply()
+                items.append(item)
+            raise gen.Return(items)
+        raise CacheResponseError('unknown reply: %r' % line)
+
+    def execute_command(self, *args):
+        return self._send(_encode_command(args), self._read_reply)
+
+    def get(self, name):
+        return self.execute_command('GET', name)
+
+    @gen.coroutine
+    def set(self, name, value, ex=None, nx=False):
+        args = ['SET', name, value]
+        if ex:
+            args.extend(['EX', ex])
+        if nx:
+            args.append('NX')
+        reply = yield self.execute_command(*args)
+        raise gen.Return(reply == 'OK')
+
+    def setex(self, name, time, value):
+        return self.execute_command('SETEX', name, time, value)
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
+
+    def mget(self, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        return self.execute_command('MGET', *(list(keys) + list(args)))
+
+    def incr(self, name, amount=1):
+        return self.execute_command('INCRBY', name, amount)
+
+    def expire(self, name, time):
+        return self.execute_command('EXPIRE', name, time)
+
+    def hget(self, name, key):
+        return self.execute_command('HGET', name, key)
+
+    def hset(self, name, key, value):
+        return self.execute_command('HSET', name, key, value)
+
+    def hdel(self, name, *keys):
+        return self.execute_command('HDEL', name, *keys)
+
+    def hmget(self, name, keys):
+        return self.execute_command('HMGET', name, *keys)
+
+    def hmset(self, name, mapping):
+        args = []
+        for key, value in mapping.iteritems():
+            args.extend([key, value])
+        return self.execute_command('HMSET', name, *args)
+
+    def zadd(self, name, value, score):
+        return self.execute_command('ZADD', name, score, value)
+
+    def zrange(self, name, start, end):
+        return self.execute_command('ZRANGE', name, start, end)
+
+    def publish(self, channel, message):
+        return self.execute_command('PUBLISH', channel, message)
+
+
+#: flags used by python-memcache, values stay readable by both clients
+_FLAG_PICKLE = 1 << 0
+_FLAG_INTEGER = 1 << 1
+_FLAG_LONG = 1 << 2
+
+
+class AsyncShardedRedis(ShardedRedis):
+    """:class:`AsyncRedis` nodes on a hash ring, the multi key commands are
+    sent to the nodes concurrently instead of from threads.
+    """
+    @gen.coroutine
+    def mget(self, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        keys = list(keys) + list(args)
+        groups = self._group(keys)
+        names = list(groups)
+        replies = yield [self.nodes[name].mget([key for i, key in groups[name]])
+                         for name in names]
+        values = [None] * len(keys)
+        for name, reply in zip(names, replies):
+            for (index, key), value in zip(groups[name], reply):
+                values[index] = value
+        raise gen.Return(values)
+
+    @gen.coroutine
+    def delete(self, *names):
+        groups = self._group(names)
+        replies = yield [self.nodes[name].delete(*[key for i, key in group])
+                         for name, group in groups.iteritems()]
+        raise gen.Return(sum(replies))
+
+
+class AsyncMemcache(_AsyncClient):
+    """Non-blocking memcache client for one server, talking the text
+    protocol.
+    """
+    def __init__(self, server='127.0.0.1:11211'):
+        host, port = server.split(':')
+        super(AsyncMemcache, self).__init__(host, port)
+
+    @gen.coroutine
+    def _read_line(self):
+        line = yield self._stream.read_until('\r\n')
+        raise gen.Return(line[:-2])
+
+    @gen.coroutine
+    def _read_values(self):
+        values = {}
+        while True:
+            line = yield self._read_line()
+            if line == 'END':
+                raise gen.Return(values)
+            if not line.startswith('VALUE '):
+                raise gen.Return(CacheResponseError(line))
+            parts = line.split()
+            key, flags, length = parts[1], int(parts[2]), int(parts[3])
+            data = yield self._stream.read_bytes(length + 2)
+            values[key] = self._decode(data[:-2], flags)
+
+    @gen.coroutine
+    def _read_status(self):
+        line = yield self._read_line()
+        if 'ERROR' in line:
+            raise gen.Return(CacheResponseError(line))
+        raise gen.Return(line)
+
+    def _encode(self, value):
+        if isinstance(value, str):
+            return 0, value
+        if isinstance(value, unicode):
+            return 0, value.encode('utf-8')
+        if isinstance(value, bool):
+            return _FLAG_PICKLE, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        if isinstance(value, int):
+            return _FLAG_INTEGER, str(value)
+        if isinstance(value, long):
+            return _FLAG_LONG, str(value)
+        return _FLAG_PICKLE, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, data, flags):
+        if flags & _FLAG_PICKLE:
+            return cPickle.loads(data)
+        if flags & _FLAG_INTEGER:
+            return int(data)
+        if flags & _FLAG_LONG:
+            return long(data)
+        return data
+
+    def _store(self, command, key, val, time):
+        flags, data = self._encode(val)
+        payload = '%s %s %d %d %d\r\n%s\r\n' % (
+            command, key, flags, time, len(data), data)
+        return self._send(payload, self._read_status)
+
+    @gen.coroutine
+    def get(self, key):
+        values = yield self._send('get %s\r\n' % key, self._read_values)
+        raise gen.Return(values.get(key))
+
+    @gen.coroutine
+    def get_multi(self, keys, key_prefix=''):
+        keys = list(keys)
+        if not keys:
+            raise gen.Return({})
+        prefixed = dict(('%s%s' % (key_prefix, key), key) for key in keys)
+        values = yield self._send('get %s\r\n' % ' '.join(prefixed),
+                                  self._read_values)
+        raise gen.Return(dict((prefixed[k], v) for k, v in values.items()))
+
+    @gen.coroutine
+    def set(self, key, val, time=0):
+        status = yield self._store('set', key, val, time)
+        raise gen.Return(status == 'STORED')
+
+    @gen.coroutine
+    def add(self, key, val, time=0):
+        status = yield self._store('add', key, val, time)
+        raise gen.Return(status == 'STORED')
+
+    @gen.coroutine
+    def delete(self, key, time=0):
+        status = yield self._send('delete %s\r\n' % key, self._read_status)
+        raise gen.Return(status == 'DELETED')
+
+    @gen.coroutine
+    def incr(self, key, delta=1):
+        command = 'incr' if delta >= 0 else 'decr'
+        status = yield self._send('%s %s %d\r\n' % (command, key, abs(delta)),
+                                  self._read_status)
+        if status == 'NOT_FOUND':
+            raise gen.Return(None)
+        raise gen.Return(int(status))
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+
+def _memcache_hash(key):
+    """The server hash of a key in python-memcache."""
+    return (((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff) or 1
+
+
+class AsyncShardedMemcache(object):
+    """:class:`AsyncMemcache` clients of several servers.  Keys are placed
+    like python-memcache places them, ``servers`` are ``'host:port'`` or
+    ``('host:port', weight)``, so both clients use the same server for a
+    key.
+    """
+    def __init__(self, servers):
+        self.buckets = []
+        for server in servers:
+            weight = 1
+            if isinstance(server, (list, tuple)):
+                server, weight = server
+            self.buckets.extend([AsyncMemcache(server)] * weight)
+
+    def get_node(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.buckets[_memcache_hash(key) % len(self.buckets)]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            return getattr(self.get_node(key), name)(key, *args, **kwargs)
+        command.__name__ = name
+        return command
+
+    @gen.coroutine
+    def get_multi(self, keys, key_prefix=''):
+        groups = {}
+        for key in keys:
+            node = self.get_node('%s%s' % (key_prefix, key))
+            groups.setdefault(node, []).append(key)
+        replies = yield [node.get_multi(group, key_prefix)
+                         for node, group in groups.iteritems()]
+        values = {}
+        for reply in replies:
+            values.update(reply)
+        raise gen.Return(values)
+
+
+class AsyncCacheAdapter(object):
+    """Wraps a blocking cache, every method returns a resolved Future.
+
+    It is used for the in-process caches, and as a fake of the network
+    clients in tests.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getattr__(self, name):
+        method = getattr(self.cache, name)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            future = Future()
+            try:
+                future.set_result(method(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return wrapper
+
+
+def create_async_redis():
+    if isinstance(complex_cache, _Cache):
+        return AsyncCacheAdapter(complex_cache)
+    clients = options.redis_clients
+    if isinstance(clients, (list, tuple)):
+        return AsyncShardedRedis.from_options(
+            clients, lambda host, port, node: AsyncRedis(host, port,
+                                                         node.get('db', 0)))
+    return AsyncRedis(clients['host'], clients['port'], clients.get('db', 0))
+
+
+def create_async_memcache():
+    if isinstance(simple_cache, (_Cache, SharedMemoryCache)):
+        return AsyncCacheAdapter(simple_cache)
+    servers = options.memcache_clients
+    if len(servers) == 1:
+        server = servers[0]
+        if isinstance(server, (list, tuple)):
+            server = server[0]
+        return AsyncMemcache(server)
+    if type(simple_cache).__module__ != 'memcache':
+        #: pylibmc hashes keys with libmemcached, its placement differs
+        raise ValueError('several memcache servers need python-memcache, '
+                         'not %s' % type(simple_cache).__module__)
+    return AsyncShardedMemcache(servers)
+
+
+async_complex_cache = create_async_redis()
+async_simple_cache = create_async_memcache()
+
+
+class async_autocached(object):
+    """Coroutine version of :class:`dojang.cache.autocached`, the decorated
+    method may return a value or a Future.
+    """
+    def __init__(self, prefix, time=0, serializer=None):
+        self.prefix = prefix
+        self.time = time
+        self.serializer = serializer
+
+    def __call__(self, method):
+        @functools.wraps(method)
+        @gen.coroutine
+        def wrapper(cls, *args):
+            key = options.site_cache_prefix + self.prefix
+            if args:
+                key += '-'.join(map(str, args))
+            value = yield async_complex_cache.get(key)
+            if value is not None:
+                raise gen.Return(deserialize(value))
+            value = method(cls, *args)
+            if is_future(value):
+                value = yield value
+            data = _dumps(self.prefix, value, self.serializer)
+            yield async_complex_cache.set(key, data, self.time)
+            raise gen.Return(value)
+        return wrapper
+
+
+def async_autocache_get(key):
+    return async_complex_cache.get(options.site_cache_prefix + key)
+
+
+def async_autocache_set(key, value, time=0):
+    return async_complex_cache.set(options.site_cache_prefix + key, value,
+                                   time)
+
+
+def async_autocache_mget(keys):
+    return async_complex_cache.mget(keys)
+
+
+def _send_commands(cache, commands):
+    return [getattr(cache, name)(*args) for name, args in commands]
+
+
+@gen.coroutine
+def async_get_cache_list(model, id_list, key_hash, time=600,
+                         site_prefix=None, serializer=None,
+                         negative_time=None):
+    """Coroutine version of :func:`dojang.cache.get_cache_list`, with the
+    same chunks and tombstones.  Only the cache round trips are
+    non-blocking.
+    """
+    lookup = _CacheListLookup(id_list, key_hash, time, site_prefix,
+                              negative_time)
+    if not lookup.ids:
+        raise gen.Return(OrderedDict())
+    replies = yield _send_commands(async_complex_cache, lookup.reads())
+    lookup.read(replies)
+    if lookup.missing:
+        yield _send_commands(async_complex_cache,
+                             lookup.writes(model, serializer))
+        lookup.wrote()
+    raise gen.Return(lookup.result())
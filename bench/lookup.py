@@ -0,0 +1,131 @@
+"""Query building cost of the ``filter_by`` and ``order_by`` lookups.
+
+Times each call with the memoized lookup plans of
+:class:`dojang.database.BaseQuery`, and with a copy of the methods they
+replaced, which parse every lookup on every call.  Run it with the dojang
+package importable::
+
+    python bench/lookup.py [number]
+"""
+
+import sys
+import timeit
+
+from tornado.options import define
+
+define('sqlalchemy_engine', default='sqlite://')
+define('site_cache_prefix', default='bench:')
+
+from sqlalchemy.orm.util import _entity_descriptor
+from sqlalchemy.util import to_list
+
+from dojang.database import BaseQuery, db
+
+
+class Author(db.Model):
+    __tablename__ = 'bench_author'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(20))
+
+
+class Book(db.Model):
+    __tablename__ = 'bench_book'
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(20))
+    author_id = db.Column(db.Integer, db.ForeignKey('bench_author.id'))
+    author = db.relationship(Author)
+
+
+class _ParsingQuery(BaseQuery):
+    """``order_by`` and ``_filter_or_exclude`` before the lookup plans
+    were memoized.
+    """
+
+    def order_by(self, *args):
+        args = list(args)
+        joins_needed = []
+        for idx, arg in enumerate(args):
+            if not isinstance(arg, basestring):
+                continue
+            if arg[0] in '+-':
+                desc = arg[0] == '-'
+                arg = arg[1:]
+            else:
+                desc = False
+            q = self
+            column = None
+            for token in arg.split('__'):
+                column = _entity_descriptor(q._joinpoint_zero(), token)
+                if column.impl.uses_objects:
+                    q = q.join(column)
+                    joins_needed.append(column)
+                    column = None
+            if column is None:
+                raise ValueError('Tried to order by table, column expected')
+            if desc:
+                column = column.desc()
+            args[idx] = column
+
+        q = super(BaseQuery, self).order_by(*args)
+        for join in joins_needed:
+            q = q.join(join)
+        return q
+
+    def _filter_or_exclude(self, negate, kwargs):
+        q = self
+        negate_if = lambda expr: expr if not negate else ~expr
+        column = None
+
+        for arg, value in kwargs.iteritems():
+            for token in arg.split('__'):
+                if column is None:
+                    column = _entity_descriptor(q._joinpoint_zero(), token)
+                    if column.impl.uses_objects:
+                        q = q.join(column)
+                        column = None
+                elif token in self._underscore_operators:
+                    op = self._underscore_operators[token]
+                    q = q.filter(negate_if(op(column, *to_list(value))))
+                    column = None
+                else:
+                    raise ValueError('No idea what to do with %r' % token)
+            if column is not None:
+                q = q.filter(negate_if(column == value))
+                column = None
+            q = q.reset_joinpoint()
+        return q
+
+
+def cases(query):
+    return [
+        ('filter_by(title=...)', lambda: query.filter_by(title='x')),
+        ('filter_by(id__in=...)',
+         lambda: query.filter_by(id__in=set([1, 2]))),
+        ('filter_by(author__name__istartswith=...)',
+         lambda: query.filter_by(author__name__istartswith='a')),
+        ("order_by('-title')", lambda: query.order_by('-title')),
+        ("order_by('author__name')", lambda: query.order_by('author__name')),
+    ]
+
+
+def measure(build, number, repeat=5):
+    """Best of ``repeat`` of the cost of one ``build``, in microseconds."""
+    return min(timeit.repeat(build, number=number, repeat=repeat)) \
+        / number * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    db.create_all()
+    session = db.session()
+    before = cases(_ParsingQuery(Book, session=session))
+    after = cases(BaseQuery(Book, session=session))
+    print 'per call, best of 5 x %d, microseconds' % number
+    print '%-42s %8s %8s' % ('', 'before', 'after')
+    for (name, parsing), (_, memoized) in zip(before, after):
+        print '%-42s %8.1f %8.1f' % (name, measure(parsing, number),
+                                     measure(memoized, number))
+
+
+if __name__ == '__main__':
+    main()
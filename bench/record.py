@@ -0,0 +1,135 @@
+"""Flush cost of :class:`dojang.database._SignalTrackingMapperExtension`.
+
+Times ``_record`` for inserts and updates of ``rows`` rows on an
+in-memory sqlite, and compares it with the walk over every property it
+replaced.  Run it with the dojang package importable::
+
+    python bench/record.py [rows]
+
+Modes:
+
+* ``none``: nobody listens to ``models_committed``
+* ``receiver``: a receiver listens, every column is recorded
+* ``track``: a receiver listens, the model sets ``__track_changes__``
+"""
+
+import sys
+import time
+
+from tornado.options import define
+
+define('sqlalchemy_engine', default='sqlite://')
+define('site_cache_prefix', default='bench:')
+
+from sqlalchemy import orm
+from sqlalchemy.orm import attributes, object_mapper
+from sqlalchemy.orm.interfaces import EXT_CONTINUE
+from sqlalchemy.orm.properties import RelationshipProperty
+
+from dojang import database
+from dojang.database import db, models_committed
+
+
+class Row(db.Model):
+    __tablename__ = 'bench_row'
+    id = db.Column(db.Integer, primary_key=True)
+    a = db.Column(db.String(20))
+    b = db.Column(db.String(20))
+    c = db.Column(db.Integer)
+    d = db.Column(db.Integer)
+    e = db.Column(db.String(50))
+    f = db.Column(db.String(50))
+    g = db.Column(db.Integer)
+    h = db.Column(db.Integer)
+
+
+def _record_every_property(self, mapper, model, operation):
+    """The ``_record`` before the change capture was made lazy: the
+    history of every property, with or without receivers.
+    """
+    pk = tuple(mapper.primary_key_from_instance(model))
+    changes = {}
+    for prop in object_mapper(model).iterate_properties:
+        if not isinstance(prop, RelationshipProperty):
+            try:
+                history = attributes.get_history(model, prop.key)
+            except:
+                continue
+            added, unchanged, deleted = history
+            newvalue = added[0] if added else None
+            if operation == 'delete':
+                oldvalue = unchanged[0] if unchanged else None
+            else:
+                oldvalue = deleted[0] if deleted else None
+            if newvalue or oldvalue:
+                changes[prop.key] = (oldvalue, newvalue)
+    key = (model.__tablename__,) + pk
+    orm.object_session(model)._model_changes[key] = \
+        (model.__tablename__, pk[0], changes, operation)
+    return EXT_CONTINUE
+
+
+def receiver(sender, changes):
+    pass
+
+
+def measure(record, rows, repeat=3):
+    """Best of ``repeat`` of the ``record`` time per inserted and per
+    updated row, in microseconds.
+    """
+    spent = [0.0]
+
+    def timed(self, *args):
+        started = time.time()
+        try:
+            return record(self, *args)
+        finally:
+            spent[0] += time.time() - started
+
+    extension = database._SignalTrackingMapperExtension
+    original = extension.__dict__['_record']
+    extension._record = timed
+    inserts, updates = [], []
+    try:
+        for i in xrange(repeat):
+            spent[0] = 0
+            for id in xrange(rows):
+                db.session.add(Row(id=id, a='a', b='b', c=id, d=id, e='e',
+                                   f='f', g=id, h=id))
+            db.session.flush()
+            inserts.append(spent[0])
+            spent[0] = 0
+            for row in Row.query.all():
+                row.c += 1
+            db.session.flush()
+            updates.append(spent[0])
+            db.session.commit()
+            Row.query.delete()
+            db.session.commit()
+            db.session.expunge_all()
+    finally:
+        extension._record = original
+    return (min(inserts) / rows * 1e6, min(updates) / rows * 1e6)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    db.create_all()
+    print '_record per row, %d rows, microseconds' % rows
+    print '%-9s %14s %14s %14s %14s' % ('mode', 'before insert',
+                                         'before update', 'after insert',
+                                         'after update')
+    current = database._SignalTrackingMapperExtension.__dict__['_record']
+    for mode in ('none', 'receiver', 'track'):
+        if mode != 'none':
+            models_committed.connect(receiver)
+        if mode == 'track':
+            Row.__track_changes__ = ('c',)
+            database._tracked_columns.clear()
+        before = measure(_record_every_property, rows)
+        after = measure(current, rows)
+        print '%-9s %14.1f %14.1f %14.1f %14.1f' % ((mode,) + before + after)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,106 @@
+from array import array
+import bisect
+from collections import OrderedDict
+import copy
 import cPickle
 import functools
+import heapq
+import json
 import logging
+import os
+import sys
 from time import time as sys_time
+import zlib
 
+from tornado import ioloop
 from tornado.options import options
 
+from .serializer import dumps as serialize, loads as deserialize
+from .sharding import ShardedRedis
+from .shmcache import SharedMemoryCache
+from .util import set_default_option
 
-__all__ = ['cached', 'autocache']
+
+__all__ = ['cached', 'autocache', 'register_invalidation']
+
+
+set_default_option('cache_max_entries', default=0, type=int,
+                   help='max entries of the in-process cache, 0 is unbounded')
+set_default_option('cache_max_bytes', default=0, type=int,
+                   help='max bytes of the in-process cache, 0 is unbounded')
+set_default_option('cache_sweep_interval', default=1000, type=int,
+                   help='milliseconds between two expiry sweeps')
+set_default_option('cache_sweep_budget', default=5, type=int,
+                   help='milliseconds one slice of the expiry sweep runs at '
+                        'most')
+set_default_option('cache_lock_timeout', default=10, type=int,
+                   help='seconds a cache recompute lock is held at most')
+set_default_option('cache_local_max_entries', default=10000, type=int,
+                   help='max entries of the local tier in front of redis')
+set_default_option('cache_local_time', default=60, type=int,
+                   help='seconds a value stays in the local tier at most')
+set_default_option('cache_invalidation_poll', default=100, type=int,
+                   help='milliseconds between two reads of the invalidation '
+                        'channel')
+set_default_option('cache_snapshot_path', default='', type=str,
+                   help='file of the snapshot of the in-process cache')
+set_default_option('cache_snapshot_interval', default=0, type=int,
+                   help='seconds between two snapshots, 0 to only write it '
+                        'on shutdown')
+set_default_option('cache_snapshot_load_timeout', default=1.0, type=float,
+                   help='seconds spent loading the snapshot at most')
+set_default_option('cache_list_chunk_size', default=500, type=int,
+                   help='ids per redis command and IN query of get_cache_list')
+set_default_option('cache_negative_time', default=60, type=int,
+                   help='seconds a missing id is remembered by the cache '
+                        'lists, 0 to disable')
+set_default_option('cache_hot_threshold', default=1000, type=int,
+                   help='reads of a complex_cache key in a window which make '
+                        'it hot, 0 to disable')
+set_default_option('cache_hot_window', default=10, type=int,
+                   help='seconds after which the read counts are halved')
+set_default_option('cache_hot_time', default=2, type=int,
+                   help='seconds a local copy of a hot key is kept, 0 to '
+                        'only report the hot keys')
+set_default_option('cache_hot_max_keys', default=100, type=int,
+                   help='max number of hot keys')
+set_default_option('cache_hot_sample', default=1, type=int,
+                   help='count one read in this many')
+set_default_option('cache_hot_sketch_width', default=2048, type=int,
+                   help='counters per row of the read count sketch')
 
 
 class _Cache(object):
     """python-memcahe compatable instance cache
+
+    The cache is unbounded by default.  When ``max_entries`` or ``max_bytes``
+    is given, the least recently used entries are evicted once a limit is
+    reached.
+
+    Expired entries are reclaimed on read, and by :meth:`sweep_expired`
+    which walks a heap of expiry times.  :meth:`start_sweeper` runs the
+    sweep on the IOLoop in small slices.
     """
-    def __init__(self):
-        self._app_cache = {}
+    def __init__(self, max_entries=0, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.reclaimed = 0
+        self.reclaimed_bytes = 0
+        self.last_sweep = {'keys': 0, 'bytes': 0, 'time': 0}
+        self._sweeper = None
+        self._sweeping = False
+        self.flush_all()
+
+    @classmethod
+    def create_local(cls):
+        return cls(max_entries=options.cache_max_entries,
+                   max_bytes=options.cache_max_bytes)
+
+    @property
+    def bounded(self):
+        return bool(self.max_entries or self.max_bytes)
 
     @classmethod
     def create_memcache(cls):
@@ -34,10 +121,14 @@ class _Cache(object):
                 cls._memcache = cache
                 return cls._memcache
             except ImportError:
-                cls._memcache = cls()
+                cls._memcache = cls.create_local()
                 return cls._memcache
+        elif options.cache_shm_path:
+            #: shared by all the workers of this host
+            cls._memcache = SharedMemoryCache.create()
+            return cls._memcache
         else:
-            cls._memcache = cls()
+            cls._memcache = cls.create_local()
             return cls._memcache
 
     @classmethod
@@ -48,6 +139,15 @@ class _Cache(object):
         if hasattr(options, 'redis_clients') and options.redis_clients:
             try:
                 import redis
+                if isinstance(options.redis_clients, (list, tuple)):
+                    def factory(host, port, node):
+                        pool = redis.ConnectionPool(host=host, port=port,
+                                                    db=node.get('db', 0))
+                        return redis.Redis(connection_pool=pool)
+                    cls._redis = ShardedRedis.from_options(
+                        options.redis_clients, factory)
+                    print "import redis.py, create sharded redis from %d nodes" % len(cls._redis.nodes)
+                    return cls._redis
                 pool = redis.ConnectionPool(host=options.redis_clients['host'], port=options.redis_clients['port'])
                 client =  redis.Redis(connection_pool=pool)
                 cls._redis = client
@@ -62,19 +162,150 @@ class _Cache(object):
                 # return cls._redis
         else:
             print "has no redis client options, create default redis member cache"
-            cls._redis = cls()
+            cls._redis = cls.create_local()
             return cls._redis
 
+    def _sizeof(self, key, val):
+        if not self.max_bytes:
+            #: cheap estimate, only used for reporting
+            return len(key) + sys.getsizeof(val)
+        if isinstance(val, str):
+            return len(key) + len(val)
+        try:
+            return len(key) + len(cPickle.dumps(val, cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return len(key) + sys.getsizeof(val)
+
+    def _remove(self, key):
+        _store = self._app_cache.pop(key, None)
+        if _store:
+            self._bytes -= _store[3]
+        return _store
+
+    def _evict(self):
+        while (self.max_entries and len(self._app_cache) > self.max_entries) \
+              or (self.max_bytes and self._bytes > self.max_bytes):
+            key, _store = self._app_cache.popitem(last=False)
+            self._bytes -= _store[3]
+            self.evictions += 1
+            self.evicted_bytes += _store[3]
+
+    def get_stats(self):
+        """python-memcache compatable stats, counter names follow memcached.
+        """
+        stats = {
+            'curr_items': len(self._app_cache),
+            'bytes': self._bytes,
+            'limit_maxitems': self.max_entries,
+            'limit_maxbytes': self.max_bytes,
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+            'reclaimed': self.reclaimed,
+            'reclaimed_bytes': self.reclaimed_bytes,
+            'last_sweep_keys': self.last_sweep['keys'],
+            'last_sweep_bytes': self.last_sweep['bytes'],
+        }
+        return [('local', stats)]
 
     def flush_all(self):
-        self._app_cache = {}
+        if self.bounded:
+            self._app_cache = OrderedDict()
+        else:
+            self._app_cache = {}
+        self._bytes = 0
+        #: heap of (expire_at, key), stale records are skipped by the sweep
+        self._expiry = []
+
+    def _schedule_expiry(self, key, expire_at):
+        heap = self._expiry
+        if len(heap) > 2 * len(self._app_cache) + 1024:
+            #: keys which are set again and again leave stale records
+            heap[:] = [(s[1] + s[2], k) for k, s in self._app_cache.iteritems()
+                       if s[2]]
+            heapq.heapify(heap)
+        heapq.heappush(heap, (expire_at, key))
+
+    def sweep_expired(self, budget=None):
+        """Reclaim expired entries for at most ``budget`` milliseconds, so
+        that one sweep never stalls the IOLoop.
+
+        Returns a ``(keys, bytes)`` tuple of what was reclaimed.
+        """
+        if budget is None:
+            budget = options.cache_sweep_budget
+        now = sys_time()
+        deadline = now + budget / 1000.0
+        heap = self._expiry
+        keys = size = checked = 0
+        while heap and heap[0][0] <= now:
+            checked += 1
+            if not checked % 64 and sys_time() > deadline:
+                break
+            expire_at, key = heapq.heappop(heap)
+            _store = self._app_cache.get(key, None)
+            if _store and _store[2] and _store[1] + _store[2] == expire_at:
+                self._remove(key)
+                keys += 1
+                size += _store[3]
+
+        self.reclaimed += keys
+        self.reclaimed_bytes += size
+        self.last_sweep = {'keys': keys, 'bytes': size, 'time': now}
+        return keys, size
+
+    def _sweep_due(self):
+        return bool(self._expiry) and self._expiry[0][0] <= sys_time()
+
+    def _sweep(self, budget=None):
+        """One slice of the sweep, the next slice runs on the next IOLoop
+        iteration while expired records remain.
+        """
+        self.sweep_expired(budget)
+        if self._sweeper is not None and self._sweep_due():
+            self._sweeping = True
+            ioloop.IOLoop.current().add_callback(self._sweep, budget)
+        else:
+            self._sweeping = False
+
+    def start_sweeper(self, interval=None, budget=None):
+        """Sweep every ``interval`` milliseconds, in slices of ``budget``
+        milliseconds until nothing expired is left.
+        """
+        if self._sweeper is not None:
+            return self._sweeper
+        if interval is None:
+            interval = options.cache_sweep_interval
+
+        def sweep():
+            if not self._sweeping:
+                self._sweep(budget)
+        self._sweeper = ioloop.PeriodicCallback(sweep, interval)
+        self._sweeper.start()
+        return self._sweeper
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+            self._sweeping = False
 
     def set(self, key, val, time=0):
         key = str(key)
         if time < 0:
             time = 0
 
-        self._app_cache[key] = (val, sys_time(), time)
+        size = self._sizeof(key, val)
+        self._remove(key)
+        if self.max_bytes and size > self.max_bytes:
+            #: like memcached, never store an item larger than the cache
+            return val
+        begin = sys_time()
+        self._app_cache[key] = (val, begin, time, size)
+        self._bytes += size
+        if time:
+            self._schedule_expiry(key, begin + time)
+        if self.bounded:
+            self._evict()
         return val
 
     def get(self, key):
@@ -82,22 +313,25 @@ class _Cache(object):
         _store = self._app_cache.get(key, None)
         if not _store:
             return None
-        value, begin, seconds = _store
+        value, begin, seconds, size = _store
         if seconds and sys_time() > begin + seconds:
-            del self._app_cache[key]
+            self._remove(key)
             return None
+        if self.bounded:
+            #: mark as most recently used
+            self._app_cache[key] = self._app_cache.pop(key)
         return value
 
     def add(self, key, val, time=0):
         key = str(key)
-        if key not in self._app_cache:
-            return self.set(key, val, time)
-        return self.get(key)
+        if self.get(key) is None:
+            self.set(key, val, time)
+            return True
+        return False
 
     def delete(self, key, time=0):
         key = str(key)
-        if key in self._app_cache:
-            del self._app_cache[key]
+        self._remove(key)
         return None
 
     def incr(self, key, delta=1):
@@ -106,9 +340,9 @@ class _Cache(object):
         if not _store:
             return None
 
-        value, begin, seconds = _store
+        value, begin, seconds, size = _store
         if seconds and sys_time() > begin + seconds:
-            del self._app_cache[key]
+            self._remove(key)
             return None
 
         if isinstance(value, basestring):
@@ -142,19 +376,786 @@ class _Cache(object):
 
         return None
 
+    def mget(self, keys):
+        """redis compatable multi get"""
+        return [self.get(key) for key in keys]
+
+    def _ttl(self, key):
+        """Seconds left of ``key``, 0 when it never expires."""
+        _store = self._app_cache.get(str(key))
+        if not _store or not _store[2]:
+            return 0
+        return max(_store[1] + _store[2] - sys_time(), 0.001)
+
+    def _hash(self, key):
+        value = self.get(key)
+        return value if isinstance(value, dict) else {}
+
+    def hmget(self, key, fields):
+        """redis compatable hash multi get"""
+        hash = self._hash(key)
+        return [hash.get(str(field)) for field in fields]
+
+    def hmset(self, key, mapping):
+        """redis compatable hash multi set, the hash keeps its timeout"""
+        hash = dict(self._hash(key))
+        for field, value in mapping.iteritems():
+            hash[str(field)] = value
+        self.set(key, hash, self._ttl(key))
+        return True
+
+    def hdel(self, key, *fields):
+        """redis compatable hash delete"""
+        hash = dict(self._hash(key))
+        count = 0
+        for field in fields:
+            if hash.pop(str(field), None) is not None:
+                count += 1
+        if hash:
+            self.set(key, hash, self._ttl(key))
+        else:
+            self.delete(key)
+        return count
+
+    def expire(self, key, seconds):
+        """redis compatable expire"""
+        value = self.get(key)
+        if value is None:
+            return False
+        self.set(key, value, seconds)
+        return True
+
+    def dump(self, path):
+        """Write the live entries to ``path``, least recently used first.
+
+        Every entry is a ``(key, value, expires)`` pickle, entries which
+        can not be pickled are skipped.  The file is replaced atomically.
+        """
+        now = sys_time()
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        count = 0
+        with open(tmp, 'wb') as f:
+            f.write(_SNAPSHOT_MAGIC)
+            for key, _store in self._app_cache.items():
+                value, begin, seconds, size = _store
+                expires = begin + seconds if seconds else 0
+                if expires and expires <= now:
+                    continue
+                try:
+                    data = cPickle.dumps((key, value, expires),
+                                         cPickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    continue
+                f.write(data)
+                count += 1
+        os.rename(tmp, path)
+        return count
+
+    def load(self, path, timeout=None):
+        """Load the entries of a snapshot written by :meth:`dump`, expired
+        entries are skipped.  Loading stops after ``timeout`` seconds.
+        """
+        deadline = None
+        if timeout:
+            deadline = sys_time() + timeout
+        count = 0
+        with open(path, 'rb') as f:
+            if f.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+                logging.warning("%s is not a cache snapshot", path)
+                return count
+            unpickler = cPickle.Unpickler(f)
+            while deadline is None or sys_time() < deadline:
+                try:
+                    key, value, expires = unpickler.load()
+                except EOFError:
+                    break
+                except Exception as e:
+                    logging.warning("broken cache snapshot %s: %s", path, e)
+                    break
+                if expires:
+                    expires -= sys_time()
+                    if expires <= 0:
+                        continue
+                self.set(key, value, expires)
+                count += 1
+        return count
+
+
+_SNAPSHOT_MAGIC = 'dojang-cache-snapshot-1\n'
+
 
 simple_cache = _Cache.create_memcache()
 complex_cache =_Cache.create_redis()
 redis_cache = complex_cache
 
 
+class TieredCache(object):
+    """A bounded in-process cache (L1) in front of ``complex_cache`` (L2).
+
+    Values stay in L1 for ``cache_local_time`` seconds at most.  Writes and
+    deletes are published on a redis channel, and every process drops its
+    L1 copy of these keys when it reads the channel.
+    """
+    def __init__(self, l2, max_entries=None, time=None):
+        if max_entries is None:
+            max_entries = options.cache_local_max_entries
+        if time is None:
+            time = options.cache_local_time
+        self.l1 = _Cache(max_entries=max_entries)
+        self.l2 = l2
+        self.time = time
+        self.stats = {'l1_hits': 0, 'l1_misses': 0,
+                      'l2_hits': 0, 'l2_misses': 0}
+        self._pubsub = None
+        self._poller = None
+
+    @property
+    def channel(self):
+        return options.site_cache_prefix + 'invalidate'
+
+    def _local_time(self, time):
+        if time and time < self.time:
+            return time
+        return self.time
+
+    def _l2_get(self, keys):
+        """Returns the values of ``keys`` in L2 and the seconds they may
+        stay in L1: their remaining time in L2, capped at ``time``.
+        """
+        if not hasattr(self.l2, 'pttl'):
+            return self.l2.mget(keys), [self.time] * len(keys)
+        pipe = _pipeline(self.l2)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+        times = []
+        for ttl in replies[1::2]:
+            if ttl is None or ttl < 0:
+                #: no timeout
+                times.append(self.time)
+            else:
+                times.append(min(self.time, ttl / 1000.0))
+        return replies[::2], times
+
+    def get(self, key):
+        return self.mget([key])[0]
+
+    def mget(self, keys):
+        values = [self.l1.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        self.stats['l1_hits'] += len(keys) - len(missing)
+        self.stats['l1_misses'] += len(missing)
+        if missing:
+            fetched, times = self._l2_get([keys[i] for i in missing])
+            for i, value, time in zip(missing, fetched, times):
+                if value is None:
+                    self.stats['l2_misses'] += 1
+                    continue
+                self.stats['l2_hits'] += 1
+                if time > 0:
+                    self.l1.set(keys[i], value, time)
+                values[i] = value
+        return values
+
+    def set(self, key, value, time=0):
+        self.l2.set(key, value, time)
+        self.l1.set(key, value, self._local_time(time))
+        self.publish(key)
+        return value
+
+    def add(self, key, value, time=0):
+        if _cache_add(self.l2, key, value, time):
+            self.publish(key)
+            return True
+        return False
+
+    def incr(self, key, delta=1):
+        value = self.l2.incr(key, delta)
+        self.l1.delete(key)
+        self.publish(key)
+        return value
+
+    def delete(self, *keys):
+        _delete_keys(self.l2, keys)
+        self.invalidate(keys)
+        self.publish(*keys)
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.l1.delete(key)
+
+    def publish(self, *keys):
+        if hasattr(self.l2, 'publish'):
+            self.l2.publish(self.channel, json.dumps(keys))
+
+    def subscribe(self):
+        """Start reading the invalidation channel on the IOLoop, it must be
+        called in every process after forking.
+        """
+        if self._poller is not None or not hasattr(self.l2, 'pubsub'):
+            return
+        self._pubsub = self.l2.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+        self._poller = ioloop.PeriodicCallback(
+            self._read_invalidations, options.cache_invalidation_poll)
+        self._poller.start()
+
+    def _read_invalidations(self):
+        while True:
+            message = self._pubsub.get_message()
+            if not message:
+                return
+            try:
+                keys = json.loads(message['data'])
+            except (TypeError, ValueError):
+                logging.warning("bad cache invalidation message %r", message)
+                continue
+            self.invalidate(keys)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['l1'] = self.l1.get_stats()[0][1]
+        return stats
+
+
+tiered_cache = TieredCache(complex_cache)
+
+
+class CountMinSketch(object):
+    """Approximate access counts of keys in ``depth`` rows of ``width``
+    counters, an estimate is never below the real count.
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0]) * width for i in xrange(depth)]
+
+    def _indexes(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1 = zlib.crc32(key) & 0xffffffff
+        h2 = zlib.adler32(key) & 0xffffffff
+        return [(h1 + i * h2) % self.width for i in xrange(self.depth)]
+
+    def add(self, key, count=1):
+        """Count ``key`` and returns its estimate."""
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index]
+                   for row, index in zip(self.rows, self._indexes(key)))
+
+    def decay(self):
+        """Halve all the counters, so old traffic fades out."""
+        for row in self.rows:
+            for i in xrange(self.width):
+                row[i] >>= 1
+
+
+class HotKeyCache(object):
+    """Front of ``complex_cache`` which samples the reads in a
+    :class:`CountMinSketch`, and keeps the keys read ``cache_hot_threshold``
+    times in a ``cache_hot_window`` in a local copy for ``cache_hot_time``
+    seconds.  The copies live in the local tier of :data:`tiered_cache`,
+    so its invalidations drop them too.  Other methods go to ``l2``.
+    """
+    def __init__(self, l2, local):
+        self.l2 = l2
+        self.local = local
+        self.sketch = CountMinSketch(options.cache_hot_sketch_width)
+        #: key -> estimate of the keys over the threshold
+        self.hot = {}
+        self.reads = 0
+        self.promotions = 0
+        self.window_started = sys_time()
+
+    def __getattr__(self, name):
+        if name == 'setnx':
+            #: _cache_add must go through add, to drop the local copies
+            raise AttributeError(name)
+        return getattr(self.l2, name)
+
+    def _count(self, key):
+        """Sample a read of ``key``, returns whether the key is hot."""
+        sample = options.cache_hot_sample
+        self.reads += 1
+        if self.reads % sample:
+            return key in self.hot
+        now = sys_time()
+        if now - self.window_started > options.cache_hot_window:
+            self._decay(now)
+        threshold = options.cache_hot_threshold
+        estimate = self.sketch.add(key, sample)
+        if not threshold or estimate < threshold:
+            return key in self.hot
+        if key not in self.hot and len(self.hot) >= options.cache_hot_max_keys:
+            coldest = min(self.hot, key=self.hot.get)
+            if self.hot[coldest] >= estimate:
+                return False
+            self._demote(coldest)
+        self.hot[key] = estimate
+        return True
+
+    def _decay(self, now):
+        self.window_started = now
+        self.sketch.decay()
+        threshold = options.cache_hot_threshold
+        for key, estimate in self.hot.items():
+            estimate >>= 1
+            if estimate < threshold:
+                self._demote(key)
+            else:
+                self.hot[key] = estimate
+
+    def _demote(self, key):
+        del self.hot[key]
+        self.local.delete(key)
+
+    def _promote(self, key, value):
+        if options.cache_hot_time and value is not None:
+            self.local.set(key, value, options.cache_hot_time)
+            self.promotions += 1
+
+    def get(self, key):
+        if not self._count(key):
+            return self.l2.get(key)
+        value = self.local.get(key)
+        if value is None:
+            value = self.l2.get(key)
+            self._promote(key, value)
+        return value
+
+    def mget(self, keys):
+        values = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if self._count(key):
+                values[i] = self.local.get(key)
+            if values[i] is None:
+                missing.append(i)
+        if missing:
+            fetched = self.l2.mget([keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                values[i] = value
+                if keys[i] in self.hot:
+                    self._promote(keys[i], value)
+        return values
+
+    def _forget(self, keys):
+        """Drop the local copies of ``keys``, and tell the other processes
+        when one of them is hot.
+        """
+        for key in keys:
+            self.local.delete(key)
+        hot = [key for key in keys if key in self.hot]
+        if hot:
+            tiered_cache.publish(*hot)
+
+    def set(self, key, value, time=0):
+        result = self.l2.set(key, value, time)
+        self._forget([key])
+        return result
+
+    def add(self, key, value, time=0):
+        if _cache_add(self.l2, key, value, time):
+            self._forget([key])
+            return True
+        return False
+
+    def incr(self, key, delta=1):
+        value = self.l2.incr(key, delta)
+        self._forget([key])
+        return value
+
+    def delete(self, *keys):
+        _delete_keys(self.l2, keys)
+        self._forget(keys)
+
+    def hot_keys(self):
+        """The hot keys by estimated reads in the current window, with
+        whether a local copy of them is held now.
+        """
+        return [{'key': key, 'estimate': estimate,
+                 'promoted': self.local.get(key) is not None}
+                for key, estimate in sorted(self.hot.iteritems(),
+                                            key=lambda item: -item[1])]
+
+    def get_stats(self):
+        return {'reads': self.reads, 'promotions': self.promotions,
+                'hot_keys': self.hot_keys()}
+
+
+hot_cache = HotKeyCache(complex_cache, tiered_cache.l1)
+
+
+def hot_keys():
+    """The keys of ``complex_cache`` which are read the most now."""
+    return hot_cache.hot_keys()
+
+
+def save_cache_snapshot():
+    """Snapshot ``simple_cache`` to ``cache_snapshot_path``, if it is an
+    in-process cache.
+    """
+    path = options.cache_snapshot_path
+    if not path or not isinstance(simple_cache, _Cache):
+        return
+    try:
+        count = simple_cache.dump(path)
+    except (IOError, OSError) as e:
+        logging.warning("can not write cache snapshot %s: %s", path, e)
+        return
+    logging.info("write %d cache entries to %s", count, path)
+
+
+def restore_cache_snapshot():
+    """Warm ``simple_cache`` up from ``cache_snapshot_path``, in at most
+    ``cache_snapshot_load_timeout`` seconds.
+    """
+    path = options.cache_snapshot_path
+    if not path or not isinstance(simple_cache, _Cache) \
+       or not os.path.exists(path):
+        return
+    try:
+        count = simple_cache.load(path, options.cache_snapshot_load_timeout)
+    except (IOError, OSError) as e:
+        logging.warning("can not read cache snapshot %s: %s", path, e)
+        return
+    logging.info("load %d cache entries from %s", count, path)
+
+
+_snapshot_callback = None
+
+
+def start_cache_tasks():
+    """Start the expiry sweep of the in-process caches, the invalidation
+    reader of the local tier, the flush of the write-behind counters and
+    the periodic cache snapshot.  Memcache and redis expire keys by
+    themselves.
+    """
+    from .counter import counters
+
+    global _snapshot_callback
+    for cache in (simple_cache, complex_cache, tiered_cache.l1):
+        if isinstance(cache, _Cache):
+            cache.start_sweeper()
+    tiered_cache.subscribe()
+    counters.start()
+    if options.cache_snapshot_path and options.cache_snapshot_interval \
+       and _snapshot_callback is None:
+        _snapshot_callback = ioloop.PeriodicCallback(
+            save_cache_snapshot, options.cache_snapshot_interval * 1000)
+        _snapshot_callback.start()
+
+
+class CacheStats(object):
+    """Counters and latency histograms of the cache helpers, keyed by cache
+    prefix and operation.
+    """
+    #: upper bounds of the latency histogram buckets, in milliseconds
+    latency_buckets = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.prefixes = {}
+
+    def _get(self, prefix):
+        stats = self.prefixes.get(prefix)
+        if stats is None:
+            stats = self.prefixes[prefix] = {
+                'hits': 0, 'misses': 0, 'sets': 0, 'deletes': 0,
+                'bytes_read': 0, 'bytes_written': 0, 'values_written': 0,
+                'max_value_size': 0, 'latency': {},
+            }
+        return stats
+
+    def record(self, prefix, operation, started, hits=0, misses=0, sets=0,
+               deletes=0, bytes_read=0):
+        """Record one ``operation`` which started at ``started``."""
+        elapsed = (sys_time() - started) * 1000
+        stats = self._get(prefix)
+        stats['hits'] += hits
+        stats['misses'] += misses
+        stats['sets'] += sets
+        stats['deletes'] += deletes
+        stats['bytes_read'] += bytes_read
+
+        latency = stats['latency'].get(operation)
+        if latency is None:
+            latency = stats['latency'][operation] = {
+                'count': 0, 'total_ms': 0.0,
+                'histogram': [0] * (len(self.latency_buckets) + 1),
+            }
+        latency['count'] += 1
+        latency['total_ms'] += elapsed
+        latency['histogram'][
+            bisect.bisect_left(self.latency_buckets, elapsed)] += 1
+
+    def written(self, prefix, size):
+        stats = self._get(prefix)
+        stats['bytes_written'] += size
+        stats['values_written'] += 1
+        stats['max_value_size'] = max(stats['max_value_size'], size)
+
+    def snapshot(self):
+        prefixes = copy.deepcopy(self.prefixes)
+        for stats in prefixes.itervalues():
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = lookups and float(stats['hits']) / lookups
+        return {'latency_buckets': self.latency_buckets,
+                'prefixes': prefixes}
+
+
+cache_stats = CacheStats()
+
+
+def get_cache_stats():
+    """Statistics of the cache helpers and of the in-process caches."""
+    stats = cache_stats.snapshot()
+    stats['tiered_cache'] = tiered_cache.get_stats()
+    stats['hot_cache'] = hot_cache.get_stats()
+    for name, cache in (('simple_cache', simple_cache),
+                        ('complex_cache', complex_cache)):
+        if isinstance(cache, (_Cache, SharedMemoryCache)):
+            stats[name] = cache.get_stats()[0][1]
+    return stats
+
+
+def _dumps(prefix, value, serializer=None):
+    data = serialize(value, serializer)
+    cache_stats.written(prefix, len(data))
+    return data
+
+
+def get_serialized_sizes():
+    """Serialized value sizes by cache prefix: count, total and max bytes.
+    """
+    sizes = {}
+    for prefix, stats in cache_stats.prefixes.iteritems():
+        if stats['values_written']:
+            sizes[prefix] = {'count': stats['values_written'],
+                             'bytes': stats['bytes_written'],
+                             'max': stats['max_value_size']}
+    return sizes
+
+
+def _cache_add(cache, key, value, time=0):
+    if hasattr(cache, 'setnx'):
+        #: redis
+        return bool(cache.set(key, value, ex=time or None, nx=True))
+    return bool(cache.add(key, value, time))
+
+
+def _delete_keys(cache, keys, pipe=None):
+    """Delete ``keys`` of ``cache``, or queue it on its ``pipe``.  Redis
+    deletes them in one command, the memcache clients one by one.
+    """
+    target = pipe if pipe is not None else cache
+    if hasattr(cache, 'setnx'):
+        target.delete(*keys)
+    else:
+        for key in keys:
+            target.delete(key)
+
+
+def _acquire_lock(cache, key, timeout=None):
+    if timeout is None:
+        timeout = options.cache_lock_timeout
+    return _cache_add(cache, key, 1, timeout)
+
+
+def _namespace_key(namespace):
+    return '%sns:%s' % (options.site_cache_prefix, namespace)
+
+
+def get_namespace_generation(namespace, cache=None):
+    """Current generation of ``namespace``, it is embedded in the keys of
+    the namespace.  A missing generation starts from the current time, so
+    a lost counter does not bring back keys of an older generation.
+    """
+    if cache is None:
+        cache = complex_cache
+    key = _namespace_key(namespace)
+    generation = cache.get(key)
+    if generation is None:
+        _cache_add(cache, key, _new_generation())
+        generation = cache.get(key)
+    return int(generation)
+
+
+def _new_generation():
+    """First generation of a namespace, in milliseconds so that it is
+    above the generations lost before, unless they were bumped more than
+    a thousand times a second.
+    """
+    return int(sys_time() * 1000)
+
+
+def _queue_bump(pipe, cache, key):
+    """Queue the bump of the generation ``key`` of ``cache`` on ``pipe``.
+    A missing generation is seeded first, ``INCR`` alone would restart it
+    from 1 and bring back the keys of an older generation.
+    """
+    if hasattr(cache, 'setnx'):
+        pipe.set(key, _new_generation(), nx=True)
+    else:
+        pipe.add(key, _new_generation())
+    pipe.incr(key)
+
+
+def bump_namespace(namespace, cache=None):
+    """Invalidate every key of ``namespace`` in one round trip, the keys of
+    the old generation are never read again and age out by their timeout.
+    """
+    if cache is None:
+        #: also drops the generation from the local tier of all processes
+        bump_namespaces([namespace])
+        return
+    key = _namespace_key(namespace)
+    #: the client behind the local front caches
+    client = getattr(cache, 'l2', cache)
+    pipe = _pipeline(client)
+    _queue_bump(pipe, client, key)
+    pipe.execute()
+    if client is not cache:
+        #: their local copies live in the local tier
+        tiered_cache.invalidate([key])
+        tiered_cache.publish(key)
+
+
+def bump_namespaces(namespaces):
+    """:func:`bump_namespace` of all ``namespaces`` in one pipelined batch.
+    """
+    keys = [_namespace_key(namespace) for namespace in namespaces]
+    if not keys:
+        return
+    pipe = _pipeline(complex_cache)
+    for key in keys:
+        _queue_bump(pipe, complex_cache, key)
+    pipe.execute()
+    tiered_cache.invalidate(keys)
+    tiered_cache.publish(*keys)
+
+
+def namespace_prefix(namespace=None, cache=None):
+    """Key prefix of ``namespace``: site prefix, namespace and generation.
+    """
+    if namespace is None:
+        return options.site_cache_prefix
+    generation = get_namespace_generation(namespace, cache)
+    return '%s%s:%d:' % (options.site_cache_prefix, namespace, generation)
+
+
+def namespaced_key(key, namespace=None, cache=None):
+    return namespace_prefix(namespace, cache) + key
+
+
+#: first item of the soft envelope, tells it from a cached list
+_SOFT_MARKER = '__soft__'
+
+
+def _cache_lookup(cache, key, loads=None, prefix=None, soft=False):
+    """Returns ``(found, value, fresh)`` of ``key``.  With ``soft``, the
+    value is stored as ``[_SOFT_MARKER, value, expires]``: it is stale but
+    still served after ``expires`` while one caller refreshes it.  A plain
+    list works with every serializer.  Values without the marker, written
+    before ``soft_time`` was set, are plain values and stale.
+    """
+    started = sys_time()
+    raw = cache.get(key)
+    if raw is None:
+        cache_stats.record(prefix, 'get', started, misses=1)
+        return False, None, False
+    cache_stats.record(prefix, 'get', started, hits=1,
+                       bytes_read=len(raw) if loads else 0)
+    value = loads(raw) if loads else raw
+    if soft:
+        if (isinstance(value, (list, tuple)) and len(value) == 3
+                and value[0] == _SOFT_MARKER):
+            return True, value[1], value[2] > sys_time()
+        return True, value, False
+    return True, value, True
+
+
+def _load_or_compute(cache, prefix, key, compute, time=0, soft_time=0,
+                     lock=False, loads=None, dumps=None):
+    """Returns the cached value of ``key``, or computes and caches it.
+
+    With ``soft_time``, the value is stale after ``soft_time`` seconds.  A
+    short lock in ``complex_cache`` makes sure only one caller of all
+    processes recomputes it, the others serve the stale value until the
+    hard ``time`` runs out.  ``lock`` without ``soft_time`` makes ``time``
+    the soft window, and keeps the stale copy for the lock timeout more.
+    Without a stale value the callers which lose the lock compute it too,
+    waiting would block the IOLoop.
+    """
+    if lock and not soft_time:
+        soft_time = time
+        time += options.cache_lock_timeout
+    found, value, fresh = _cache_lookup(cache, key, loads, prefix,
+                                        bool(soft_time))
+    if found and fresh:
+        return value
+
+    locked = False
+    lock_key = key + ':lock'
+    if soft_time:
+        locked = _acquire_lock(complex_cache, lock_key)
+        if not locked and found:
+            return value
+
+    try:
+        value = compute()
+        stored = value
+        if soft_time:
+            stored = [_SOFT_MARKER, value, sys_time() + soft_time]
+        if dumps:
+            stored = dumps(stored)
+        started = sys_time()
+        cache.set(key, stored, time)
+        cache_stats.record(prefix, 'set', started, sets=1)
+    finally:
+        if locked:
+            complex_cache.delete(lock_key)
+    return value
+
+
+def _check_lock(time, soft_time, lock):
+    if lock and not (time or soft_time):
+        #: nothing would ever be stale
+        raise ValueError('lock needs a time or a soft_time')
+
+
 class cached(object):
     """Cache decorator, an easy way to manage cache.
     The result key will be like: prefix:arg1-arg2
+
+    Set ``soft_time`` to serve the stale value while one caller
+    recomputes it, the value is stale after ``soft_time`` seconds and
+    expires after ``time``::
+
+        @cached('hot_topics', time=600, soft_time=60)
+        def hot_topics(cls):
+            ...
+
+    ``lock`` alone does the same with ``time`` as the soft window: the
+    value is stale after ``time``, and the stale copy is served for the
+    lock timeout more while it is recomputed.
     """
-    def __init__(self, prefix, time=0):
+    def __init__(self, prefix, time=0, soft_time=0, lock=False):
+        _check_lock(time, soft_time, lock)
         self.prefix = prefix
         self.time = time
+        self.soft_time = soft_time
+        self.lock = lock
 
     def __call__(self, method):
         @functools.wraps(method)
@@ -163,48 +1164,83 @@ class cached(object):
                 key = self.prefix + ':' + '-'.join(map(str, args))
             else:
                 key = self.prefix
-            value = simple_cache.get(key)
-            if value is None:
-                value = method(cls, *args)
-                simple_cache.set(key, value, self.time)
-            return value
+            return _load_or_compute(
+                simple_cache, self.prefix, key, lambda: method(cls, *args),
+                self.time, self.soft_time, self.lock)
         return wrapper
 
 def cached_clear(key):
+    started = sys_time()
     simple_cache.delete(key)
+    cache_stats.record(key.split(':', 1)[0], 'delete', started, deletes=1)
 
 class autocached(object):
     """Cache decorator, an easy way to manage redis_cache.
     The result key will be like: prefix:arg1-arg2
+
+    ``soft_time`` and ``lock`` work like they do in :class:`cached`.
+    Values are stored with ``serializer``, see :mod:`dojang.serializer`.
+    Set ``local`` to keep a copy in the in-process tier of
+    :data:`tiered_cache`, for values which almost never change.
+
+    With ``namespace`` the key belongs to a namespace, and
+    :func:`bump_namespace` invalidates all of them at once.  The namespace
+    is formatted with the arguments::
+
+        @autocached('topics', namespace='node:{0}')
+        def get_topics(cls, node_id, page):
+            ...
+
+        bump_namespace('node:%d' % node_id)
     """
-    def __init__(self, prefix, time=0):
+    def __init__(self, prefix, time=0, soft_time=0, lock=False,
+                 namespace=None, serializer=None, local=False):
+        _check_lock(time, soft_time, lock)
         self.prefix = prefix
         self.time = time
+        self.soft_time = soft_time
+        self.lock = lock
+        self.namespace = namespace
+        self.serializer = serializer
+        self.cache = _autocache(local)
+
+    def dumps(self, value):
+        return _dumps(self.prefix, value, self.serializer)
 
     def __call__(self, method):
         @functools.wraps(method)
         def wrapper(cls, *args):
-            key = options.site_cache_prefix+self.prefix
+            key = self.prefix
             if args:
-                key = options.site_cache_prefix+self.prefix +  '-'.join(map(str, args))
-            # else:
-            #     key = self.prefix
-            value = complex_cache.get(key)
-            if value is None:
-                value = method(cls, *args)
-                v = cPickle.dumps(value)
-                complex_cache.set(key, v, self.time)
-
-            else:                
-                logging.debug("complex_cache load from cache", key)
-                value = cPickle.loads(value)
-            return value
+                key = self.prefix +  '-'.join(map(str, args))
+            namespace = self.namespace
+            if namespace is not None:
+                namespace = namespace.format(*args)
+            key = namespaced_key(key, namespace, self.cache)
+            return _load_or_compute(
+                self.cache, self.prefix, key, lambda: method(cls, *args),
+                self.time, self.soft_time, self.lock,
+                loads=deserialize, dumps=self.dumps)
         return wrapper
 
-def autocache_del(key):
-    logging.debug("complex_cache delete from cache", key)
-    key = options.site_cache_prefix + key
-    complex_cache.delete(key)
+def _autocache(local):
+    return tiered_cache if local else hot_cache
+
+
+def autocache_del(key, namespace=None, local=False, prefix=None):
+    """Delete ``key``, the delete is counted in the stats of ``prefix``,
+    the prefix given to :class:`autocached`.  Without it, the part of
+    ``key`` before a ``:``, or ``autocache`` for the keys without one.
+    """
+    logging.debug("complex_cache delete from cache %s", key)
+    cache = _autocache(local)
+    if prefix is None:
+        #: one stats entry per key would grow without bound
+        prefix = key.split(':', 1)[0] if ':' in key else 'autocache'
+    key = namespaced_key(key, namespace, cache)
+    started = sys_time()
+    cache.delete(key)
+    cache_stats.record(prefix, 'delete', started, deletes=1)
     # if isinstance(key, list):
     #     for k in key:
     #         complex_cache.delete(k)
@@ -212,8 +1248,24 @@ def autocache_del(key):
     #     complex_cache.delete(key)
 
 def autocache_del_pattern(key_pattern):
-    logging.debug("complex_cache delete pattern from cache", key_pattern)
-    keys = complex_cache.keys(options.site_cache_prefix+key_pattern)
+    """Delete keys matching ``key_pattern``.
+
+    It walks the keyspace with SCAN, which is still O(N) over all keys.
+    Prefer keeping such keys in a namespace and :func:`bump_namespace`.
+    """
+    logging.debug("complex_cache delete pattern from cache %s", key_pattern)
+    pattern = options.site_cache_prefix + key_pattern
+    if hasattr(complex_cache, 'scan_iter'):
+        batch = []
+        for key in complex_cache.scan_iter(match=pattern, count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                complex_cache.delete(*batch)
+                batch = []
+        if batch:
+            complex_cache.delete(*batch)
+        return
+    keys = complex_cache.keys(pattern)
     if keys:
         for key in keys:
             complex_cache.delete(key)
@@ -221,89 +1273,548 @@ def autocache_del_pattern(key_pattern):
         logging.debug("del pattern keys is none")
 
 
-def autocache_get(key):
-    return complex_cache.get(options.site_cache_prefix+key)
+def autocache_get(key, namespace=None, local=False):
+    cache = _autocache(local)
+    return cache.get(namespaced_key(key, namespace, cache))
 
-def autocache_set(key, value, time=0):
-    complex_cache.set(options.site_cache_prefix+key, value, time)
+def autocache_set(key, value, time=0, namespace=None, local=False):
+    cache = _autocache(local)
+    cache.set(namespaced_key(key, namespace, cache), value, time)
 
-def autocache_mget(keys):
-    return complex_cache.mget(keys)
+def autocache_mget(keys, namespace=None, local=False):
+    cache = _autocache(local)
+    if namespace is not None:
+        prefix = namespace_prefix(namespace, cache)
+        keys = [prefix + key for key in keys]
+    return cache.mget(keys)
 
 
-def autocache_incr(key, value):
-    return complex_cache.incr(options.site_cache_prefix+key, value)
+def autocache_incr(key, value, namespace=None, buffered=False):
+    """Increment the counter ``key``.  With ``buffered`` the increment is
+    written behind by :data:`dojang.counter.counters` and ``None`` is
+    returned, read the counter with ``counters.get``.
+    """
+    key = namespaced_key(key, namespace)
+    if buffered:
+        from .counter import counters
+        counters.incr(key, value)
+        return None
+    return complex_cache.incr(key, value)
 
-def autocache_hdel(key, id):
-    complex_cache.hdel(options.site_cache_prefix+key, id)
+def autocache_hdel(key, id, namespace=None):
+    """Delete ``id`` from the plain hash ``key``.  The hashes of
+    :func:`get_cache_list` are split in time buckets, use
+    :func:`cache_list_del` for them.
+    """
+    complex_cache.hdel(namespaced_key(key, namespace), id)
 
-def autocache_hget(key, id):
-    return complex_cache.hget(options.site_cache_prefix+key, id)
+def autocache_hget(key, id, namespace=None):
+    return complex_cache.hget(namespaced_key(key, namespace), id)
     
-def autocache_hset(key, id):
-    complex_cache.hset(options.site_cache_prefix+key, id)
+def autocache_hset(key, id, namespace=None):
+    complex_cache.hset(namespaced_key(key, namespace), id)
+
+def autocache_zadd(key, value, score, namespace=None):
+    complex_cache.zadd(namespaced_key(key, namespace),  str(value), score)
+
+def autocache_zrange(key, start, end, namespace=None):
+    return complex_cache.zrange(namespaced_key(key, namespace), start, end)
+
+
+
+def _watch_key(tablename):
+    return '%swatch:%s' % (options.site_cache_prefix, tablename)
+
+
+#: tables known to be watched
+_watched_tables = set()
+#: tablename -> time until which it is known to be unwatched, the rows of
+#: a flush do not all go to the local tier
+_unwatched_tables = {}
+
+
+def watch_table(tablename):
+    """Record the changes of ``tablename`` in every process, it has cached
+    queries or tombstones.  The other processes see it once they read the
+    invalidation channel, see :meth:`TieredCache.subscribe`.
+    """
+    if tablename in _watched_tables:
+        return
+    _watched_tables.add(tablename)
+    key = _watch_key(tablename)
+    _cache_add(complex_cache, key, '1')
+    tiered_cache.invalidate([key])
+    tiered_cache.publish(key)
+
+
+def is_watched_table(tablename):
+    if tablename in _watched_tables:
+        return True
+    now = sys_time()
+    if _unwatched_tables.get(tablename, 0) > now:
+        return False
+    key = _watch_key(tablename)
+    value = tiered_cache.l1.get(key)
+    if value is None:
+        #: the unwatched tables are kept in L1 too, watch_table publishes
+        #: the key to drop them
+        value = complex_cache.get(key) or '0'
+        tiered_cache.l1.set(key, value, tiered_cache.time)
+    if value == '1':
+        _watched_tables.add(tablename)
+        return True
+    _unwatched_tables[tablename] = now + 1
+    return False
+
 
-def autocache_zadd(key, value, score):
-    complex_cache.zadd(options.site_cache_prefix+key,  str(value), score)
+def _connect_models_committed(receiver):
+    """Connect ``receiver`` to ``models_committed``, it only receives the
+    changes of the tables cached by dojang.  The database module is
+    imported lazily, it is only needed once models are cached.
+    """
+    from .database import _connect_scoped
+    try:
+        _connect_scoped(receiver)
+    except RuntimeError:
+        logging.warning("blinker is not installed, %s will not receive "
+                        "model changes", receiver.__name__)
+
+
+#: tablename -> set of (kind, name, negative_time), where tombstones live
+_tombstones = {}
+
+
+def _tombstones_key(tablename):
+    return '%stombstones:%s' % (options.site_cache_prefix, tablename)
+
+
+def _register_tombstones(model, kind, name, negative_time):
+    tombstone = (kind, name, negative_time)
+    tombstones = _tombstones.setdefault(model.__tablename__, set())
+    if tombstone in tombstones:
+        return
+    tombstones.add(tombstone)
+    watch_table(model.__tablename__)
+    if hasattr(complex_cache, 'sadd'):
+        #: the inserts committed by the other processes drop them too
+        complex_cache.sadd(_tombstones_key(model.__tablename__),
+                           json.dumps(tombstone))
+
+
+def _load_tombstones(tablenames):
+    """``{tablename: set of (kind, name, negative_time)}`` of this process
+    and of the others.
+    """
+    tombstones = dict((tablename, set(_tombstones.get(tablename, ())))
+                      for tablename in tablenames)
+    if hasattr(complex_cache, 'smembers'):
+        pipe = _pipeline(complex_cache)
+        for tablename in tablenames:
+            pipe.smembers(_tombstones_key(tablename))
+        for tablename, members in zip(tablenames, pipe.execute()):
+            for member in members or ():
+                kind, name, negative_time = json.loads(member)
+                tombstones[tablename].add(
+                    (kind, str(name), negative_time))
+    return tombstones
+
+
+def _drop_tombstones(sender, changes):
+    """A missing id may be inserted later, forget its tombstone."""
+    inserted = [(tablename, pk) for tablename, pk, _, operation in changes
+                if operation in ('insert', 'upsert') and pk is not None and
+                is_watched_table(tablename)]
+    if not inserted:
+        return
+    tombstones = _load_tombstones(list(set(
+        tablename for tablename, pk in inserted)))
+    pipe = None
+    for tablename, pk in inserted:
+        for kind, name, negative_time in tombstones[tablename]:
+            if kind == 'simple':
+                simple_cache.delete('%s%s' % (name, pk))
+                continue
+            if pipe is None:
+                pipe = _pipeline(complex_cache)
+            for bucket in _list_buckets(name, negative_time):
+                pipe.hdel(bucket, str(pk))
+    if pipe is not None:
+        pipe.execute()
+
+
+class _Invalidation(object):
+    def __init__(self, model, keys, hashes, namespaces, simple_keys, refresh,
+                 serializer):
+        self.model = model
+        self.keys = keys
+        self.hashes = hashes
+        self.namespaces = namespaces
+        self.simple_keys = simple_keys
+        self.refresh = refresh
+        self.serializer = serializer
+
+
+#: tablename -> list of _Invalidation
+_invalidations = {}
+
+
+def register_invalidation(model, keys=(), hashes=(), namespaces=(),
+                          simple_keys=(), refresh=False, serializer=None):
+    """Drop cache entries of ``model`` when a change of one of its rows is
+    committed.  ``model`` is a model class, a table or a table name.
 
-def autocache_zrange(key, start, end):
-    return complex_cache.zrange(options.site_cache_prefix+key, start, end)
+    ``keys`` and ``simple_keys`` are keys of ``complex_cache`` and
+    ``simple_cache``, ``namespaces`` are bumped.  They are format strings
+    of the primary key ``{pk}`` and of the columns of the row, or callables
+    of ``(pk, changes)`` which return a list of them.  ``hashes`` are
+    :func:`get_cache_list` hashes, as ``key_hash`` or ``(key_hash, time)``.
 
+    With ``refresh``, inserted and updated rows are written to ``hashes``
+    instead of deleted from them, ``model`` must be a model class::
+
+        register_invalidation(Topic, keys=['topic:{pk}'],
+                              hashes=['topics'],
+                              namespaces=['node:{node_id}'],
+                              refresh=True)
+
+    The entries of one commit are deleted in one pipelined batch.
+    """
+    if isinstance(model, basestring):
+        tablename = model
+    else:
+        tablename = getattr(model, '__tablename__', None) or model.name
+    if refresh and not hasattr(model, 'query'):
+        raise ValueError('refresh needs a model class, not %r' % model)
+    hashes = [(name, 600) if isinstance(name, basestring) else tuple(name)
+              for name in hashes]
+    if not _invalidations:
+        _connect_models_committed(_invalidate_committed)
+    _invalidations.setdefault(tablename, []).append(_Invalidation(
+        model, list(keys), hashes, list(namespaces), list(simple_keys),
+        refresh, serializer))
+
+
+def _row_values(instance, changes):
+    """The column values of a changed row: the ones of the flushed
+    ``instance`` when it is known, updated by ``changes``.
+    """
+    values = {}
+    if instance is not None:
+        from sqlalchemy.orm.attributes import instance_state
+        values.update(instance_state(instance).dict)
+    values.update((name, new if new is not None else old)
+                  for name, (old, new) in changes.iteritems())
+    return values
+
+
+def _format_keys(templates, pk, changes, values):
+    keys = []
+    for template in templates:
+        if callable(template):
+            keys.extend(template(pk, changes))
+            continue
+        try:
+            keys.append(template.format(**dict(values, pk=pk)))
+        except (KeyError, IndexError):
+            #: the rows of bulk writes only have their written columns
+            logging.warning("can not invalidate %s of %s, a column is not "
+                            "known", template, pk)
+    return keys
+
+
+def _load_committed(model, pks):
+    """Load ``pks`` of ``model`` in a new session, the session which sent
+    ``models_committed`` can not run queries anymore.
+    """
+    from sqlalchemy import orm
+    from .database import db
+
+    session = orm.Session(
+        bind=db.get_engine(model.__table__.info.get('bind_key')))
+    try:
+        pk = model.__mapper__.primary_key[0]
+        return session.query(model).filter(pk.in_(pks)).all()
+    finally:
+        session.close()
+
+
+def _invalidate_committed(sender, changes):
+    keys = set()
+    simple_keys = set()
+    namespaces = set()
+    hash_fields = []
+    refreshes = {}
+    for change in changes:
+        tablename, pk, columns, operation = change
+        rules = _invalidations.get(tablename)
+        if not rules:
+            continue
+        values = _row_values(getattr(change, 'instance', None), columns)
+        for rule in rules:
+            keys.update(_format_keys(rule.keys, pk, columns, values))
+            simple_keys.update(_format_keys(rule.simple_keys, pk, columns,
+                                            values))
+            namespaces.update(_format_keys(rule.namespaces, pk, columns,
+                                           values))
+            if rule.refresh and operation != 'delete':
+                refreshes.setdefault(rule, set()).add(pk)
+            else:
+                hash_fields.append((rule.hashes, pk))
+    if not (keys or simple_keys or namespaces or hash_fields or refreshes):
+        return
+
+    prefix = options.site_cache_prefix
+    keys = [prefix + key for key in keys]
+    generation_keys = [_namespace_key(namespace) for namespace in namespaces]
+    pipe = _pipeline(complex_cache)
+    if keys:
+        _delete_keys(complex_cache, keys, pipe)
+    for key in generation_keys:
+        _queue_bump(pipe, complex_cache, key)
+    for hashes, pk in hash_fields:
+        for name, time in hashes:
+            for bucket in _list_buckets(prefix + name, time):
+                pipe.hdel(bucket, str(pk))
+    for rule, pks in refreshes.iteritems():
+        items = _load_committed(rule.model, pks)
+        for name, time in rule.hashes:
+            buckets = _list_buckets(prefix + name, time)
+            if items:
+                pipe.hmset(buckets[0], dict(
+                    (item.id, _dumps(name, item, rule.serializer))
+                    for item in items))
+                if time:
+                    pipe.expire(buckets[0], 2 * time)
+            for bucket in buckets[1:]:
+                pipe.hdel(bucket, *[str(pk) for pk in pks])
+    pipe.execute()
+    if simple_keys:
+        simple_cache.delete_multi(list(simple_keys))
+    #: the local tier and the hot key copies of every process
+    tiered_cache.invalidate(keys + generation_keys)
+    tiered_cache.publish(*(keys + generation_keys))
 
 
-def get_simple_cache_list(model, id_list, key_prefix, time=600, site_prefix=None):
+def get_simple_cache_list(model, id_list, key_prefix, time=600,
+                          site_prefix=None, negative_time=None):
+    """Like :func:`get_cache_list`, but the instances are stored one key per
+    id in ``simple_cache``.
+    """
     if site_prefix is None:
         site_prefix = options.site_cache_prefix
+    if negative_time is None:
+        negative_time = options.cache_negative_time
     if not id_list:
         return {}
     id_list = set(id_list)
-    data = cache.get_multi(id_list, key_prefix=site_prefix+key_prefix)
+    started = sys_time()
+    data = simple_cache.get_multi(id_list, key_prefix=site_prefix+key_prefix)
     missing = id_list - set(data)
+    miss_prefix = site_prefix + key_prefix + 'miss:'
+    if missing and negative_time:
+        missing -= set(simple_cache.get_multi(missing, key_prefix=miss_prefix))
+    cache_stats.record(key_prefix, 'get', started,
+                       hits=len(id_list) - len(missing), misses=len(missing))
     if missing:
         dct = {}
         for item in model.query.filter_by(id__in=missing).all():
             dct[item.id] = item
 
-        cache.set_multi(dct, time=time, key_prefix=key_prefix)
+        started = sys_time()
+        simple_cache.set_multi(dct, time=time,
+                               key_prefix=site_prefix+key_prefix)
+        cache_stats.record(key_prefix, 'set', started, sets=len(dct))
         data.update(dct)
 
+        missing = [id for id in missing if id not in dct]
+        if missing and negative_time:
+            _register_tombstones(model, 'simple', miss_prefix, negative_time)
+            simple_cache.set_multi(dict((id, 1) for id in missing),
+                                   time=negative_time, key_prefix=miss_prefix)
+
     return data
 
-def get_cache_list(model, id_list, key_hash, time=600, site_prefix=None):
+class _SerialPipeline(object):
+    """Runs the queued commands one by one, for clients without pipelines.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.cache, name)(*args, **kwargs)
+                for name, args, kwargs in commands]
+
+
+def _pipeline(cache):
+    if hasattr(cache, 'pipeline'):
+        return cache.pipeline(transaction=False)
+    return _SerialPipeline(cache)
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _list_buckets(name, time):
+    """The hashes of a cache list: the current time bucket and the one
+    before it.  A bucket expires ``2 * time`` seconds after it started, so
+    every entry lives between ``time`` and ``2 * time`` seconds.
+    """
+    if not time:
+        return [name]
+    bucket = int(sys_time() // time)
+    return ['%s:%d' % (name, bucket), '%s:%d' % (name, bucket - 1)]
+
+
+class _CacheListLookup(object):
+    """The cache round trips of :func:`get_cache_list`, as lists of
+    ``(command, args)``.  The blocking version pipelines them, the async
+    one of :mod:`dojang.asynccache` sends them at once.
+    """
+    def __init__(self, id_list, key_hash, time, site_prefix, negative_time):
+        if site_prefix is None:
+            site_prefix = options.site_cache_prefix
+        if negative_time is None:
+            negative_time = options.cache_negative_time
+        self.key_hash = key_hash
+        self.time = time
+        self.negative_time = negative_time
+        self.ids = []
+        seen = set()
+        for id in id_list:
+            id = str(id)
+            if id not in seen:
+                seen.add(id)
+                self.ids.append(id)
+        self.chunk_size = options.cache_list_chunk_size
+        self.buckets = _list_buckets(site_prefix + key_hash, time)
+        self.miss_name = site_prefix + key_hash + ':miss'
+        self.miss_buckets = []
+        if negative_time:
+            self.miss_buckets = _list_buckets(self.miss_name, negative_time)
+        self.found = {}
+        self.missing = []
+
+    def reads(self):
+        self.started = sys_time()
+        return [('hmget', (bucket, chunk))
+                for chunk in _chunks(self.ids, self.chunk_size)
+                for bucket in self.buckets + self.miss_buckets]
+
+    def read(self, replies):
+        found = self.found
+        tombstones = set()
+        bytes_read = 0
+        step = len(self.buckets) + len(self.miss_buckets)
+        for i, chunk in enumerate(_chunks(self.ids, self.chunk_size)):
+            chunk_replies = replies[i * step:(i + 1) * step]
+            for bucket_values in chunk_replies[:len(self.buckets)]:
+                for id, d in zip(chunk, bucket_values):
+                    if d and id not in found:
+                        bytes_read += len(d)
+                        found[id] = deserialize(d)
+            for bucket_values in chunk_replies[len(self.buckets):]:
+                for id, d in zip(chunk, bucket_values):
+                    if d:
+                        tombstones.add(id)
+        self.missing = [id for id in self.ids
+                        if id not in found and id not in tombstones]
+        cache_stats.record(self.key_hash, 'get', self.started,
+                           hits=len(self.ids) - len(self.missing),
+                           misses=len(self.missing), bytes_read=bytes_read)
+
+    def writes(self, model, serializer):
+        """Loads the misses with chunked ``IN`` queries, returns the
+        commands which cache them and the tombstones of the others.
+        """
+        commands = []
+        self.sets = 0
+        for chunk in _chunks(self.missing, self.chunk_size):
+            dct = {}
+            for item in model.query.filter_by(id__in=set(chunk)).all():
+                dct[item.id] = _dumps(self.key_hash, item, serializer)
+                self.found[str(item.id)] = item
+            if dct:
+                self.sets += len(dct)
+                commands.append(('hmset', (self.buckets[0], dct)))
+        if self.time:
+            commands.append(('expire', (self.buckets[0], 2 * self.time)))
+        missing = [id for id in self.missing if id not in self.found]
+        if missing and self.negative_time:
+            #: blocks once per process and hash
+            _register_tombstones(model, 'hash', self.miss_name,
+                                 self.negative_time)
+            commands.append(('hmset', (self.miss_buckets[0],
+                                       dict((id, 1) for id in missing))))
+            commands.append(('expire', (self.miss_buckets[0],
+                                        2 * self.negative_time)))
+        self.started = sys_time()
+        return commands
+
+    def wrote(self):
+        cache_stats.record(self.key_hash, 'set', self.started, sets=self.sets)
+
+    def result(self):
+        data_dict = OrderedDict()
+        for id in self.ids:
+            if id in self.found:
+                item = self.found[id]
+                data_dict[item.id] = item
+        return data_dict
+
+
+def _run_commands(cache, commands):
+    pipe = _pipeline(cache)
+    for name, args in commands:
+        getattr(pipe, name)(*args)
+    return pipe.execute()
+
+
+def get_cache_list(model, id_list, key_hash, time=600, site_prefix=None,
+                   serializer=None, negative_time=None):
+    """Returns the ``model`` instances of ``id_list`` as an ordered dict
+    keyed by id, in the order of ``id_list``.
+
+    Instances are cached in time bucketed hashes, see :func:`_list_buckets`.
+    Large id lists are read and written in pipelined chunks of
+    ``cache_list_chunk_size``, and the misses are loaded with chunked
+    ``IN`` queries.
+
+    Ids missing from the database are remembered for ``negative_time``
+    seconds in the sibling hashes ``key_hash:miss``, until an insert of
+    that id is committed.
+    """
+    lookup = _CacheListLookup(id_list, key_hash, time, site_prefix,
+                              negative_time)
+    if not lookup.ids:
+        return OrderedDict()
+    lookup.read(_run_commands(complex_cache, lookup.reads()))
+    if lookup.missing:
+        _run_commands(complex_cache, lookup.writes(model, serializer))
+        lookup.wrote()
+    return lookup.result()
+
+
+def cache_list_del(key_hash, ids, time=600, site_prefix=None):
+    """Delete ``ids`` from the :func:`get_cache_list` hash ``key_hash``,
+    from every time bucket of it.  ``time`` is the one given to
+    :func:`get_cache_list`.
+    """
     if site_prefix is None:
         site_prefix = options.site_cache_prefix
-        
-    if not id_list:
-        return {}
-    int_id_list = []
-    data_id_list = []
-    data_dict= dict()
-    for id in id_list:
-        int_id_list.append(str(id))
-    # str_id_list = complex_cache.hkeys('people')
-    # print str_id_list
-    if len(int_id_list)>0:
-        data = complex_cache.hmget(site_prefix+key_hash, int_id_list)
-        # return data
-        # id_list = set(id_list)
-        
-        
-        for d in data:
-            if d:
-                d_value = cPickle.loads(d)
-                #print d_value.id, d_value, type(d_value)
-                data_dict[d_value.id] = d_value
-                data_id_list.append(str(d_value.id))
-
-    missing = set(int_id_list) - set(data_id_list)
-    # print "missing", missing
-    if len(missing) > 0:
-        # print "missing2", missing
-        dct = {}
-        for item in model.query.filter_by(id__in=missing).all():
-            # print "item id", item.id
-            dct[item.id] = cPickle.dumps(item)
-            data_dict[item.id] = item
-        complex_cache.hmset(site_prefix+key_hash, dct)
-
-    return data_dict
+    ids = [str(id) for id in ids]
+    if not ids:
+        return
+    pipe = _pipeline(complex_cache)
+    for bucket in _list_buckets(site_prefix + key_hash, time):
+        pipe.hdel(bucket, *ids)
+    pipe.execute()
@@ -0,0 +1,151 @@
+"""Write-behind counters.
+
+Increments are added up in the process, and flushed every
+``counter_flush_interval`` milliseconds: the cache counters as pipelined
+``INCRBY`` commands, the model columns as one bulk ``UPDATE`` per table
+and column::
+
+    counters.incr('topic:views:%d' % topic.id)
+    counters.incr_model(Topic, topic.id, 'view_count')
+
+    views = counters.get('topic:views:%d' % topic.id)
+    view_count = counters.get_model(topic, 'view_count')
+
+The reads add the pending increments of this process to the persisted
+value, the increments of the other processes show up once they flush.
+"""
+
+import logging
+
+from sqlalchemy import bindparam
+from tornado import ioloop
+from tornado.options import options
+
+from .cache import _cache_add, _pipeline, complex_cache
+from .util import set_default_option
+
+
+__all__ = ['CounterBuffer', 'counters']
+
+
+set_default_option('counter_flush_interval', default=1000, type=int,
+                   help='milliseconds between two flushes of the counters')
+set_default_option('counter_max_pending', default=10000, type=int,
+                   help='flush the counters once this many are pending')
+
+
+class CounterBuffer(object):
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else complex_cache
+        #: key -> pending delta
+        self.keys = {}
+        #: (model, column, id) -> pending delta
+        self.columns = {}
+        self._flusher = None
+
+    def __len__(self):
+        return len(self.keys) + len(self.columns)
+
+    def _added(self):
+        if len(self) >= options.counter_max_pending:
+            self.flush()
+
+    def incr(self, key, delta=1):
+        """Add ``delta`` to the cache counter ``key``."""
+        self.keys[key] = self.keys.get(key, 0) + delta
+        self._added()
+
+    def get(self, key):
+        value = self.cache.get(key)
+        return int(value or 0) + self.keys.get(key, 0)
+
+    def incr_model(self, model, id, column, delta=1):
+        """Add ``delta`` to ``column`` of the ``model`` row ``id``."""
+        name = (model, column, id)
+        self.columns[name] = self.columns.get(name, 0) + delta
+        self._added()
+
+    def get_model(self, instance, column):
+        pk = type(instance).__mapper__.primary_key_from_instance(instance)[0]
+        pending = self.columns.get((type(instance), column, pk), 0)
+        return (getattr(instance, column) or 0) + pending
+
+    def flush(self):
+        """Write the pending deltas, the deltas which failed are kept for
+        the next flush.
+        """
+        keys, self.keys = self.keys, {}
+        columns, self.columns = self.columns, {}
+        if keys:
+            try:
+                self._flush_keys(keys)
+            except Exception:
+                logging.exception("can not flush %d counters", len(keys))
+                self._restore(self.keys, keys)
+        if columns:
+            try:
+                self._flush_columns(columns)
+            except Exception:
+                logging.exception("can not flush %d column counters",
+                                  len(columns))
+                self._restore(self.columns, columns)
+
+    def _restore(self, pending, deltas):
+        for name, delta in deltas.iteritems():
+            pending[name] = pending.get(name, 0) + delta
+
+    def _flush_keys(self, keys):
+        keys = [(key, delta) for key, delta in keys.iteritems() if delta]
+        pipe = _pipeline(self.cache)
+        for key, delta in keys:
+            pipe.incr(key, delta)
+        for (key, delta), value in zip(keys, pipe.execute()):
+            if value is None:
+                #: memcache does not create missing counters
+                _cache_add(self.cache, key, delta)
+
+    def _flush_columns(self, columns):
+        from .database import db, models_committed
+
+        #: bind key -> (model, column) -> rows
+        binds = {}
+        for (model, column, id), delta in columns.iteritems():
+            if delta:
+                bind_key = model.__table__.info.get('bind_key')
+                binds.setdefault(bind_key, {}).setdefault(
+                    (model, column), []).append((id, delta))
+
+        for bind_key, groups in binds.iteritems():
+            changes = []
+            with db.get_engine(bind_key).begin() as connection:
+                for (model, column), rows in groups.iteritems():
+                    table = model.__table__
+                    pk = model.__mapper__.primary_key[0]
+                    statement = table.update().where(
+                        pk == bindparam('_id')).values(
+                        {column: table.c[column] + bindparam('_delta')})
+                    connection.execute(statement, [
+                        {'_id': id, '_delta': delta} for id, delta in rows])
+                    for id, delta in rows:
+                        #: the new values are not known without reading them
+                        changes.append((model.__tablename__, id,
+                                        {column: (None, None)}, 'update'))
+            models_committed.send(db, changes=changes)
+
+    def start(self):
+        """Flush every ``counter_flush_interval`` milliseconds on the
+        IOLoop.
+        """
+        if self._flusher is None:
+            self._flusher = ioloop.PeriodicCallback(
+                self.flush, options.counter_flush_interval)
+            self._flusher.start()
+
+    def stop(self):
+        if self._flusher is not None:
+            self._flusher.stop()
+            self._flusher = None
+
+
+counters = CounterBuffer()
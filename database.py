@@ -11,26 +11,41 @@
 
 from __future__ import with_statement, absolute_import
 
+import base64
+import datetime
+import decimal
 from functools import partial
 import functools
+import hashlib
+import json
+import logging
+import random
 import re
 import uuid
 
-from sqlalchemy import orm
+from sqlalchemy import bindparam, orm
 import sqlalchemy
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
-from sqlalchemy.orm import attributes, object_mapper
+from sqlalchemy.orm import attributes
 from sqlalchemy.orm import joinedload, joinedload_all
 from sqlalchemy.orm.exc import UnmappedClassError
 from sqlalchemy.orm.interfaces import MapperExtension, SessionExtension, EXT_CONTINUE
-from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.util import _entity_descriptor
 from sqlalchemy.sql import operators, extract
-from sqlalchemy.util import to_list
+from sqlalchemy.sql.expression import Insert, Select
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.util import KeyedTuple, to_list
 from tornado.options import options
 import tornado.web
 
+from .cache import (_delete_keys, _drop_tombstones, _invalidations,
+                    _pipeline, bump_namespaces, complex_cache,
+                    get_namespace_generation, hot_cache, is_watched_table,
+                    simple_cache, tiered_cache, watch_table)
+from .serializer import dumps as serialize, loads as deserialize
 from .signals import Namespace
 from .util import set_default_option
 
@@ -113,18 +128,48 @@ class _BoundDeclarativeMeta(DeclarativeMeta):
         DeclarativeMeta.__init__(self, name, bases, d)
         if bind_key is not None:
             self.__table__.info['bind_key'] = bind_key
+        if getattr(self, '__cache_ttl__', None) and \
+           getattr(self, '__table__', None) is not None:
+            _identity_cached[self.__table__.name] = self
 
 
 class _SignallingSession(Session):
 
     def __init__(self, db, autocommit=False, autoflush=False, **options):
+        self.db = db
         self.sender = db.sender
         self._model_changes = {}
+        #: set after a write, the reads go to the primary until all the
+        #: requests in flight have finished
+        self._use_primary = False
+        #: requests in flight, the ioloop interleaves them on this session
+        self._requests = 0
         Session.__init__(self, autocommit=autocommit, autoflush=autoflush,
                          expire_on_commit=False,
                          extension=db.session_extensions,
                          bind=db.engine, **options)
 
+    def get_bind(self, mapper=None, clause=None):
+        """The engine of the ``__bind_key__`` of ``mapper``.  Selects go to
+        a replica of it, unless they lock rows or this session has written
+        since the requests in flight began, see
+        :meth:`SQLAlchemy.begin_request`.
+        """
+        bind_key = None
+        if mapper is not None:
+            table = getattr(mapper, 'mapped_table', None)
+            if table is not None:
+                bind_key = table.info.get('bind_key')
+        #: no clause is a connection for anything, a write maybe
+        reading = isinstance(clause, Select) and not clause.for_update
+        if reading and not self._flushing and not self._use_primary:
+            replica = self.db.get_replica(bind_key)
+            if replica is not None:
+                return replica
+        if bind_key is not None or self.db.binds:
+            return self.db.get_engine(bind_key)
+        return Session.get_bind(self, mapper, clause)
+
 
 class _QueryProperty(object):
 
@@ -152,32 +197,93 @@ class _SignalTrackingMapperExtension(MapperExtension):
         return self._record(mapper, instance, 'update')
 
     def _record(self, mapper, model, operation):
+        if not _needs_changes(model.__tablename__):
+            return EXT_CONTINUE
         pk = tuple(mapper.primary_key_from_instance(model))
         #orm.object_session(model)._model_changes[pk] = (model, operation)
+        state = attributes.instance_state(model)
         changes = {}
 
-        for prop in object_mapper(model).iterate_properties:
-            if not isinstance(prop, RelationshipProperty):
-                try:
-                    history = attributes.get_history(model, prop.key)
-                except:
-                    continue
+        for key in self._tracked_keys(mapper, state, operation):
+            if operation == 'update':
+                oldvalue = state.committed_state[key]
+                if oldvalue in (attributes.NO_VALUE, attributes.NEVER_SET):
+                    oldvalue = None
+                newvalue = state.dict.get(key)
+            elif operation == 'insert':
+                oldvalue, newvalue = None, state.dict.get(key)
+            else:
+                oldvalue, newvalue = state.dict.get(key), None
 
-                added, unchanged, deleted = history
+            if newvalue or oldvalue:
+                changes[key] = (oldvalue, newvalue)
 
-                newvalue = added[0] if added else None
+        #: primary keys of different tables may be equal
+        key = (model.__tablename__,) + pk
+        change = _ModelChange((model.__tablename__, pk[0], changes, operation))
+        change.instance = model
+        orm.object_session(model)._model_changes[key] = change
+        return EXT_CONTINUE
 
-                if operation == 'delete':
-                    oldvalue = unchanged[0] if unchanged else None
-                else:
-                    oldvalue = deleted[0] if deleted else None
+    def _tracked_keys(self, mapper, state, operation):
+        """The column keys of ``state`` which go in the changes: only the
+        modified ones of an update, and only the ``__track_changes__`` ones
+        when the model sets it.
+        """
+        columns = _tracked_column_keys(mapper)
+        if operation == 'update':
+            return columns.intersection(state.committed_state)
+        return columns.intersection(state.dict)
 
-                if newvalue or oldvalue:
-                    changes[prop.key] = (oldvalue, newvalue)
 
-        orm.object_session(model)._model_changes[pk] = \
-                (model.__tablename__, pk[0], changes, operation)
-        return EXT_CONTINUE
+class _ModelChange(tuple):
+    """``(tablename, pk, changes, operation)`` of a flushed row.  The
+    receivers which need the unchanged columns too read them from the
+    flushed ``instance``.
+    """
+    instance = None
+
+
+#: mapper -> keys of the columns whose changes are recorded
+_tracked_columns = {}
+
+
+def _tracked_column_keys(mapper):
+    columns = _tracked_columns.get(mapper)
+    if columns is None:
+        tracked = getattr(mapper.class_, '__track_changes__', None)
+        columns = frozenset(prop.key for prop in mapper.column_attrs
+                            if tracked is None or prop.key in tracked)
+        _tracked_columns[mapper] = columns
+    return columns
+
+
+def _has_receivers():
+    """Whether a receiver which wants the changes of every table listens,
+    the receivers of dojang only want the ones of its cached tables.
+    """
+    #: without blinker, nobody listens either
+    receivers = getattr(models_committed, 'receivers', None) or {}
+    return bool(getattr(before_models_committed, 'receivers', None)) or \
+        not _scoped_receivers.issuperset(receivers)
+
+
+def _needs_changes(tablename):
+    """Whether the changes of ``tablename`` are recorded."""
+    if _has_receivers():
+        return True
+    return bool(_scoped_receivers) and (
+        tablename in _identity_cached or tablename in _invalidations or
+        is_watched_table(tablename))
+
+
+#: ids of the receivers of dojang, see _has_receivers
+_scoped_receivers = set()
+
+
+def _connect_scoped(receiver):
+    models_committed.connect(receiver)
+    _scoped_receivers.add(id(receiver))
 
 
 class _SignallingSessionExtension(SessionExtension):
@@ -199,6 +305,80 @@ class _SignallingSessionExtension(SessionExtension):
         session._model_changes.clear()
         return EXT_CONTINUE
 
+    def after_flush(self, session, flush_context):
+        #: read your writes, replicas may lag behind
+        session._use_primary = True
+        return EXT_CONTINUE
+
+
+def _bump_query_tables(sender, changes):
+    """Invalidate the cached queries of the changed tables."""
+    tablenames = set(tablename for tablename, pk, _, operation in changes)
+    bump_namespaces(['table:' + tablename for tablename in tablenames
+                     if is_watched_table(tablename)])
+
+
+#: tablename -> model with a ``__cache_ttl__``
+_identity_cached = {}
+
+
+def _identity_key(tablename, pk):
+    return '%sidentity:%s:%s' % (options.site_cache_prefix, tablename, pk)
+
+
+def _identity_cache(model):
+    if model.__cache_region__ == 'simple':
+        return simple_cache
+    return hot_cache
+
+
+def _coerce_ident(column, ident):
+    """``ident`` as the python type of ``column``, the url arguments are
+    strings.
+    """
+    if not isinstance(ident, basestring):
+        return ident
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return ident
+    if issubclass(python_type, basestring):
+        return ident
+    try:
+        return python_type(ident)
+    except (TypeError, ValueError):
+        return ident
+
+
+def _drop_identities(sender, changes):
+    """Drop the cached rows of the changed rows of the identity cached
+    models.
+    """
+    keys = {}
+    for tablename, pk, _, operation in changes:
+        model = _identity_cached.get(tablename)
+        if model is not None and pk is not None:
+            keys.setdefault(_identity_cache(model), []).append(
+                _identity_key(tablename, pk))
+    for cache, names in keys.iteritems():
+        if cache is simple_cache:
+            cache.delete_multi(names)
+        else:
+            #: with the local copies of every process
+            _delete_keys(complex_cache, names)
+            tiered_cache.invalidate(names)
+            tiered_cache.publish(*names)
+
+
+try:
+    _connect_scoped(_bump_query_tables)
+    _connect_scoped(_drop_identities)
+    #: the tombstones of every process live in redis
+    _connect_scoped(_drop_tombstones)
+except RuntimeError:
+    logging.warning("blinker is not installed, cached queries, rows and "
+                    "tombstones are not invalidated by commits")
+
 
 def signalling_mapper(*args, **kwargs):
     """Replacement for mapper that injects some extra extensions"""
@@ -223,27 +403,95 @@ class _ModelTableNameDescriptor(object):
         return tablename
 
 
+def _estimate_count(query):
+    """Row count estimate of the planner of MySQL and PostgreSQL, ``None``
+    for the other databases, and when the plan has no estimate.
+    """
+    mapper = query._mapper_zero_or_none()
+    #: with the select, the plan is read from a replica like the rows
+    connection = query.session.connection(mapper=mapper,
+                                          clause=query.statement)
+    dialect = connection.dialect
+    if dialect.name == 'mysql':
+        prefix = 'EXPLAIN '
+    elif dialect.name == 'postgresql':
+        prefix = 'EXPLAIN (FORMAT JSON) '
+    else:
+        return None
+
+    compiled = query.statement.compile(dialect=dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    result = connection.execute(prefix + unicode(compiled), params)
+    if dialect.name == 'mysql':
+        #: the rows of the first table of the plan, less the filtered ones
+        row = dict(result.first())
+        if row['rows'] is None:
+            #: no table is read, "Impossible WHERE" and the likes
+            return None
+        return int(row['rows'] * float(row.get('filtered') or 100) / 100)
+    plan = result.scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
 class Pagination(object):
     def __name__(self):
         return "pagination"
 
-    def __init__(self, query=None, page=None, per_page=None, total=None):
+    def __init__(self, query=None, page=None, per_page=None, total=None,
+                 count='exact', count_ttl=None, threshold=None):
         # self.query = query
         self.per_page = per_page
         self.page = page
+        #: the total is an estimate of the database
+        self.estimated = False
 
         if query is not None:
-            self.items = query.offset((self.page - 1) * self.per_page).limit(self.per_page).all()
-            if total:
+            offset = (self.page - 1) * self.per_page
+            if count == 'window' and not total and \
+               len(query.column_descriptions) == 1:
+                #: the total comes with the rows, in one round trip
+                rows = query.add_columns(sqlalchemy.func.count().over()) \
+                            .offset(offset).limit(self.per_page).all()
+                self.items = [row[0] for row in rows]
+                if rows:
+                    total = rows[0][-1]
+                elif self.page == 1:
+                    total = 0
+            else:
+                self.items = query.offset(offset).limit(self.per_page).all()
+            if total is not None and (total or count == 'window'):
                 self.total = total
             else:
-                self.total = query.count()
-            if self.page > 1 and self.page > self.pages:
+                self.total = self._count(query, count, count_ttl, threshold)
+            if self.items:
+                #: a cached or estimated total may be behind the rows
+                self.total = max(self.total, offset + len(self.items))
+            elif self.page > 1 and self.page > self.pages and \
+                 not self.estimated:
                 raise tornado.web.HTTPError(404)
         else:
             self.items = []
             self.total = 0
 
+    def _count(self, query, count, count_ttl, threshold):
+        if count_ttl is None:
+            count_ttl = options.paginate_count_ttl
+        if threshold is None:
+            threshold = options.paginate_estimate_threshold
+        query = query.order_by(None)
+        if count == 'cached':
+            return query.cache(count_ttl).count()
+        if count == 'estimate':
+            estimate = _estimate_count(query)
+            if estimate is not None and estimate >= threshold:
+                self.estimated = True
+                return estimate
+        return query.count()
+
     def iter_pages(self, edge=4):
         if self.page <= edge:
             return range(1, min(self.pages, 2 * edge + 1) + 1)
@@ -272,6 +520,69 @@ class Pagination(object):
         return self.page + 1
 
 
+class SeekPagination(object):
+    """Keyset pagination, see :meth:`BaseQuery.seek`."""
+
+    def __init__(self, items, per_page, cursor=None, next_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _cursor_default(value):
+    if isinstance(value, datetime.datetime):
+        return {'$dt': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$d': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'$dec': str(value)}
+    raise TypeError('%r can not be in a cursor' % value)
+
+
+def _cursor_hook(dct):
+    if '$dt' in dct:
+        value = dct['$dt']
+        format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value \
+            else '%Y-%m-%dT%H:%M:%S'
+        return datetime.datetime.strptime(value, format)
+    if '$d' in dct:
+        return datetime.datetime.strptime(dct['$d'], '%Y-%m-%d').date()
+    if '$dec' in dct:
+        return decimal.Decimal(dct['$dec'])
+    return dct
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_cursor_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(cursor):
+    cursor = str(cursor)
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data, object_hook=_cursor_hook)
+    except (TypeError, ValueError):
+        raise tornado.web.HTTPError(404)
+    if not isinstance(values, list):
+        raise tornado.web.HTTPError(404)
+    return values
+
+
+#: (query class, kind, entity, lookup) -> parsed lookup plan
+_lookup_plans = {}
+_LOOKUP_PLANS_MAX = 4096
+
+
 class BaseQuery(orm.Query):
     """The default query object used for models.  This can be subclassed and
     replaced for individual models by setting the :attr:`~Model.query_class`
@@ -300,11 +611,22 @@ class BaseQuery(orm.Query):
     def limits(self, offset, count=30):
         return self.offset(offset).limit(count)
 
-    def paginate(self, page, per_page=20, error_out=True, total=None):
+    def paginate(self, page, per_page=20, error_out=True, total=None,
+                 count=None, count_ttl=None, threshold=None):
         """Returns `per_page` items from page `page`.  By default it will
         abort with 404 if no items were found and the page was larger than
         1.  This behavor can be disabled by setting `error_out` to `False`.
 
+        ``count`` is how the total is found when it is not given:
+
+        -   ``'exact'`` runs a ``COUNT(*)``.
+        -   ``'cached'`` caches the count for ``count_ttl`` seconds, like
+            :meth:`cache` does.
+        -   ``'estimate'`` uses the planner estimate of MySQL or
+            PostgreSQL when it is at least ``threshold`` rows, and the
+            exact count otherwise.
+        -   ``'window'`` selects ``COUNT(*) OVER ()`` with the rows.
+
         Returns an :class:`Pagination` object.
         """
         try:
@@ -313,7 +635,276 @@ class BaseQuery(orm.Query):
             raise tornado.web.HTTPError(404)
         if error_out and page < 1:
             raise tornado.web.HTTPError(404)
-        return Pagination(self, page, per_page, total)
+        if count is None:
+            count = options.paginate_count
+        return Pagination(self, page, per_page, total, count, count_ttl,
+                          threshold)
+
+    def seek(self, after=None, order_by=('id',), per_page=20):
+        """Keyset pagination: returns the `per_page` items which follow the
+        cursor ``after`` in the ``order_by`` order, as a
+        :class:`SeekPagination`.  Unlike :meth:`paginate`, deep pages are
+        as fast as the first one::
+
+            page = Topic.query.filter_by(node_id=1).seek(
+                after=self.get_argument('after', None),
+                order_by=('-created', 'id'))
+            next_url = '?after=%s' % page.next_cursor
+
+        ``order_by`` are column names, with ``-`` for descending order.
+        The primary key is appended when it is missing, so the order is
+        unique.  The ordering columns must not be null.
+        """
+        mapper = self._mapper_zero()
+        keys = []
+        for name in order_by:
+            desc = name.startswith('-')
+            keys.append((_entity_descriptor(mapper, name.lstrip('+-')), desc))
+        for column in mapper.primary_key:
+            if not any(key.key == column.key for key, desc in keys):
+                keys.append((_entity_descriptor(mapper, column.key), False))
+
+        q = super(BaseQuery, self).order_by(None).order_by(
+            *[key.desc() if desc else key for key, desc in keys])
+        if after is not None:
+            values = decode_cursor(after)
+            if len(values) != len(keys):
+                raise tornado.web.HTTPError(404)
+            #: (a, b) > (x, y) is a > x or (a == x and b > y)
+            clauses = []
+            for i, (key, desc) in enumerate(keys):
+                equal = [k == v for (k, d), v in zip(keys[:i], values)]
+                after_value = key < values[i] if desc else key > values[i]
+                clauses.append(sqlalchemy.and_(*(equal + [after_value])))
+            q = q.filter(sqlalchemy.or_(*clauses))
+
+        items = q.limit(per_page + 1).all()
+        next_cursor = None
+        if len(items) > per_page:
+            items = items[:per_page]
+            last = items[-1]
+            next_cursor = encode_cursor(
+                [getattr(last, key.key) for key, desc in keys])
+        return SeekPagination(items, per_page, after, next_cursor)
+
+    #: set by :meth:`cache`
+    _cache_ttl = None
+    _cache_region = 'complex'
+
+    def cache(self, ttl=60, region='complex'):
+        """Cache the results of :meth:`all`, :meth:`first` and
+        :meth:`count` for ``ttl`` seconds in ``region``, ``'simple'`` or
+        ``'complex'``.  A commit which changes one of the tables of the
+        query invalidates them::
+
+            topics = Topic.query.filter_by(node_id=1).order_by('-id') \\
+                          .limit(20).cache(300).all()
+
+        Instances are cached as snapshots of their columns, and merged into
+        the session when they are read.
+        """
+        q = self._clone()
+        q._cache_ttl = ttl
+        q._cache_region = region
+        return q
+
+    def _cache_key(self, kind):
+        statement = self.statement
+        #: the default dialect fails on the constructs of the others
+        bind = self.session.get_bind(self._mapper_zero_or_none(), statement)
+        compiled = statement.compile(dialect=bind.dialect)
+        params = dict(compiled.params)
+        params.update(self._params)
+        digest = hashlib.md5('%s\n%s\n%r' % (
+            kind, unicode(compiled).encode('utf-8'),
+            sorted(params.items()))).hexdigest()
+        tables = sorted(set(table.name for table in find_tables(
+            statement, include_aliases=True) if hasattr(table, 'name')))
+        for name in tables:
+            #: the commits of every process must bump them
+            watch_table(name)
+        generations = '-'.join(
+            str(get_namespace_generation('table:' + name, tiered_cache))
+            for name in tables)
+        return '%squery:%s:%s' % (options.site_cache_prefix, generations,
+                                  digest)
+
+    def _cached(self, kind, load, dump, compute):
+        cache = simple_cache if self._cache_region == 'simple' else hot_cache
+        key = self._cache_key(kind)
+        data = cache.get(key)
+        if data is not None:
+            return load(deserialize(data))
+        value = self._from_primary(compute)
+        cache.set(key, serialize(dump(value), 'pickle'), self._cache_ttl)
+        return value
+
+    def _from_primary(self, load):
+        """Runs ``load`` with the reads on the primary.  The rows it loads
+        are cached, a lagging replica would cache the rows from before the
+        commit which has just invalidated them.
+        """
+        session = self.session
+        use_primary = session._use_primary
+        session._use_primary = True
+        try:
+            return load()
+        finally:
+            session._use_primary = use_primary
+
+    def _cached_model(self):
+        """The model of a query of one model, ``None`` for the others."""
+        descriptions = self.column_descriptions
+        if len(descriptions) != 1:
+            return None
+        entity = descriptions[0]['type']
+        if isinstance(entity, type) and hasattr(entity, '__mapper__'):
+            return entity
+        return None
+
+    def _dump_rows(self, rows):
+        model = self._cached_model()
+        if model is None:
+            if rows and not hasattr(rows[0], 'keys'):
+                return (None, rows)
+            return (rows and rows[0].keys(), [tuple(row) for row in rows])
+        states = [attributes.instance_state(row) for row in rows]
+        keys = [prop.key for prop in model.__mapper__.column_attrs
+                if all(prop.key in state.dict for state in states)]
+        return (keys, [tuple(state.dict[key] for key in keys)
+                       for state in states])
+
+    def _load_rows(self, data):
+        keys, rows = data
+        model = self._cached_model()
+        if model is None:
+            if keys is None:
+                return rows
+            return [KeyedTuple(row, keys) for row in rows]
+        return [self._rehydrate(model, keys, row) for row in rows]
+
+    def _rehydrate(self, model, keys, row):
+        """Instance of the column values ``row``, merged into the session
+        without loading it.  The instance already in the session wins, it
+        may hold changes which are not flushed yet.
+        """
+        mapper = model.__mapper__
+        instance = mapper.class_manager.new_instance()
+        state = attributes.instance_state(instance)
+        state.dict.update(zip(keys, row))
+        key = mapper._identity_key_from_state(state)
+        current = self.session.identity_map.get(key)
+        if current is not None:
+            return current
+        state.key = key
+        return self.session.merge(instance, load=False)
+
+    def _identity_model(self):
+        """The model of this query when its rows are cached by primary
+        key, see :attr:`Model.__cache_ttl__`.
+        """
+        model = self._cached_model()
+        if model is None or not getattr(model, '__cache_ttl__', None) or \
+           self._with_options or len(model.__mapper__.primary_key) != 1:
+            return None
+        return model
+
+    def get(self, ident):
+        if self._identity_model() is None:
+            return super(BaseQuery, self).get(ident)
+        return self._get_identities([ident]).get(str(ident))
+
+    def get_many(self, ids):
+        """The instances of the primary keys ``ids`` in the order of
+        ``ids``, missing ones are skipped.  Rows of models with a
+        ``__cache_ttl__`` are read from the cache, the others and the
+        misses are loaded by one ``IN`` query.
+        """
+        found = self._get_identities(ids)
+        items = [found.get(str(id)) for id in ids]
+        return [item for item in items if item is not None]
+
+    def _get_identities(self, ids):
+        """Returns ``{str(pk): instance}`` of ``ids``."""
+        model = self._mapper_zero().class_
+        mapper = model.__mapper__
+        column = mapper.primary_key[0]
+        found = {}
+        missing = []
+        for id in ids:
+            id = _coerce_ident(column, id)
+            instance = self.session.identity_map.get(
+                mapper.identity_key_from_primary_key([id]))
+            if instance is not None:
+                found[str(id)] = instance
+            elif str(id) not in found:
+                missing.append(id)
+        if not missing:
+            return found
+
+        tablename = model.__table__.name
+        cache = None
+        if self._identity_model() is not None:
+            cache = _identity_cache(model)
+            keys = [_identity_key(tablename, id) for id in missing]
+            if cache is simple_cache:
+                #: the memcache clients have get_multi only
+                data = cache.get_multi(keys)
+                values = [data.get(key) for key in keys]
+            else:
+                values = cache.mget(keys)
+            misses = []
+            for id, data in zip(missing, values):
+                if data is None:
+                    misses.append(id)
+                    continue
+                keys, row = deserialize(data)
+                found[str(id)] = self._rehydrate(model, keys, row)
+            missing = misses
+        if not missing:
+            return found
+
+        query = self.filter(column.in_(missing))
+        if cache is not None:
+            items = self._from_primary(query.all)
+        else:
+            items = query.all()
+        snapshots = {}
+        for item in items:
+            id = mapper.primary_key_from_instance(item)[0]
+            found[str(id)] = item
+            if cache is not None:
+                keys, rows = self._dump_rows([item])
+                snapshots[_identity_key(tablename, id)] = serialize(
+                    (keys, rows[0]), 'pickle')
+        if snapshots:
+            ttl = model.__cache_ttl__
+            if cache is simple_cache:
+                cache.set_multi(snapshots, ttl)
+            else:
+                pipe = _pipeline(complex_cache)
+                for key, data in snapshots.iteritems():
+                    pipe.set(key, data, ttl)
+                pipe.execute()
+        return found
+
+    def all(self):
+        if self._cache_ttl is None:
+            return super(BaseQuery, self).all()
+        return self._cached('all', self._load_rows, self._dump_rows,
+                            lambda: super(BaseQuery, self).all())
+
+    def first(self):
+        if self._cache_ttl is None:
+            return super(BaseQuery, self).first()
+        rows = self.slice(0, 1).all()
+        return rows[0] if rows else None
+
+    def count(self):
+        if self._cache_ttl is None:
+            return super(BaseQuery, self).count()
+        return self._cached('count', lambda value: value, lambda value: value,
+                            lambda: super(BaseQuery, self).count())
 
     #: https://github.com/mitsuhiko/sqlalchemy-django-query
     """Can be mixed into any Query class of SQLAlchemy and extends it to
@@ -372,11 +963,47 @@ class BaseQuery(orm.Query):
         func = (need_all and joinedload_all or joinedload)
         return self.options(func(*columns))
 
+    def _lookup_plan(self, kind, lookup):
+        """Parsed ``lookup`` from the current join point, memoized per query
+        class, entity and lookup string.  A plan is a list of steps,
+        ``('join', relation)`` and ``('column', column, operator)``.
+        """
+        entity = self._joinpoint_zero()
+        key = (type(self), kind, entity, lookup)
+        plan = _lookup_plans.get(key)
+        if plan is None:
+            plan = self._parse_lookup(kind, entity, lookup)
+            if len(_lookup_plans) >= _LOOKUP_PLANS_MAX:
+                _lookup_plans.clear()
+            _lookup_plans[key] = plan
+        return plan
+
+    def _parse_lookup(self, kind, entity, lookup):
+        plan = []
+        column = None
+        for token in lookup.split('__'):
+            if column is None:
+                column = _entity_descriptor(entity, token)
+                if column.impl.uses_objects:
+                    plan.append(('join', column))
+                    entity = column.property.mapper
+                    column = None
+            elif kind == 'filter' and token in self._underscore_operators:
+                plan.append(('column', column, token))
+                column = None
+            else:
+                raise ValueError('No idea what to do with %r' % token)
+            if kind == 'order' and column is not None:
+                plan.append(('column', column, None))
+                column = None
+        if kind == 'filter' and column is not None:
+            plan.append(('column', column, None))
+        return plan
+
     def order_by(self, *args):
         args = list(args)
         joins_needed = []
         for idx, arg in enumerate(args):
-            q = self
             if not isinstance(arg, basestring):
                 continue
             if arg[0] in '+-':
@@ -384,14 +1011,13 @@ class BaseQuery(orm.Query):
                 arg = arg[1:]
             else:
                 desc = False
-            q = self
             column = None
-            for token in arg.split('__'):
-                column = _entity_descriptor(q._joinpoint_zero(), token)
-                if column.impl.uses_objects:
-                    q = q.join(column)
-                    joins_needed.append(column)
+            for step in self._lookup_plan('order', arg):
+                if step[0] == 'join':
+                    joins_needed.append(step[1])
                     column = None
+                else:
+                    column = step[1]
             if column is None:
                 raise ValueError('Tried to order by table, column expected')
             if desc:
@@ -406,28 +1032,59 @@ class BaseQuery(orm.Query):
     def _filter_or_exclude(self, negate, kwargs):
         q = self
         negate_if = lambda expr: expr if not negate else ~expr
-        column = None
 
         for arg, value in kwargs.iteritems():
-            for token in arg.split('__'):
-                if column is None:
-                    column = _entity_descriptor(q._joinpoint_zero(), token)
-                    if column.impl.uses_objects:
-                        q = q.join(column)
-                        column = None
-                elif token in self._underscore_operators:
+            for step in q._lookup_plan('filter', arg):
+                if step[0] == 'join':
+                    q = q.join(step[1])
+                    continue
+                column, token = step[1], step[2]
+                if token is None:
+                    q = q.filter(negate_if(column == value))
+                else:
                     op = self._underscore_operators[token]
                     q = q.filter(negate_if(op(column, *to_list(value))))
-                    column = None
-                else:
-                    raise ValueError('No idea what to do with %r' % token)
-            if column is not None:
-                q = q.filter(negate_if(column == value))
-                column = None
             q = q.reset_joinpoint()
         return q
 
 
+class _Upsert(Insert):
+    """``INSERT`` which updates ``update_cols`` of the rows conflicting on
+    ``conflict_cols``, or skips them when ``update_cols`` is empty.
+    """
+    def __init__(self, table, conflict_cols, update_cols, **kwargs):
+        Insert.__init__(self, table, **kwargs)
+        self.conflict_cols = conflict_cols
+        self.update_cols = update_cols
+
+
+@compiles(_Upsert)
+def _compile_upsert(insert, compiler, **kw):
+    sql = compiler.visit_insert(insert, **kw)
+    quote = compiler.preparer.quote_identifier
+    dialect = compiler.dialect.name
+    if dialect == 'mysql':
+        #: mysql finds the conflict by itself, on any unique key
+        updates = insert.update_cols or insert.conflict_cols[:1]
+        return sql + ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+            '%s = VALUES(%s)' % (quote(name), quote(name))
+            for name in updates)
+    if dialect in ('postgresql', 'sqlite'):
+        sql += ' ON CONFLICT (%s)' % ', '.join(
+            quote(name) for name in insert.conflict_cols)
+        if not insert.update_cols:
+            return sql + ' DO NOTHING'
+        return sql + ' DO UPDATE SET ' + ', '.join(
+            '%s = excluded.%s' % (quote(name), quote(name))
+            for name in insert.update_cols)
+    raise CompileError('upsert is not supported by %s' % dialect)
+
+
+def _chunks(rows, size):
+    for i in xrange(0, len(rows), size):
+        yield rows[i:i + size]
+
+
 class Model(object):
     """Baseclass for custom user models."""
 
@@ -441,6 +1098,114 @@ class Model(object):
 
     PER_PAGE = None
 
+    #: names of the columns whose changes are sent with
+    #: :data:`models_committed`, ``None`` for all of them.  The commits of
+    #: a model with ``()`` are still signalled, without the changes.
+    __track_changes__ = None
+
+    #: seconds :meth:`BaseQuery.get` and :meth:`BaseQuery.get_many` cache
+    #: the rows of this model by primary key, ``None`` to not cache them.
+    #: Commits of a row drop its cached copy.
+    __cache_ttl__ = None
+
+    #: ``'simple'`` or ``'complex'``, the cache of the rows
+    __cache_region__ = 'complex'
+
+    @classmethod
+    def _execute_bulk(cls, statement, rows, multivalues=True):
+        """Run ``statement`` for ``rows`` in chunks, as one multi-values
+        statement per chunk on MySQL and PostgreSQL, executemany on the
+        others.
+        """
+        session = cls.query.session
+        mapper = cls.__mapper__
+        dialect = session.get_bind(mapper, statement).dialect
+        multivalues = multivalues and dialect.name in ('mysql', 'postgresql')
+        #: read your writes, no flush marks it like for the other writes
+        session._use_primary = True
+        for chunk in _chunks(rows, options.sqlalchemy_bulk_chunk_size):
+            if multivalues:
+                session.execute(statement.values(chunk), mapper=mapper)
+            else:
+                session.execute(statement, chunk, mapper=mapper)
+
+    @classmethod
+    def _record_bulk(cls, rows, operation):
+        """Add ``rows`` to the changes of the session, they are sent with
+        the other changes by one :data:`models_committed` at commit.
+        """
+        if not _needs_changes(cls.__table__.name):
+            return
+        session = cls.query.session
+        mapper = cls.__mapper__
+        tablename = cls.__table__.name
+        pk = mapper.primary_key[0].key
+        columns = _tracked_column_keys(mapper)
+        for row in rows:
+            changes = dict((key, (None, value))
+                           for key, value in row.iteritems()
+                           if key in columns and value and
+                           not (operation == 'update' and key == pk))
+            id = row.get(pk)
+            key = (tablename, id) if id is not None \
+                else (tablename, None, len(session._model_changes))
+            session._model_changes[key] = (tablename, id, changes, operation)
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        """Insert ``rows``, a list of dicts of column values, without
+        loading them into the session.  The rows are written in the
+        transaction of the session, in chunks of
+        ``sqlalchemy_bulk_chunk_size``, and signalled on commit.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        cls._execute_bulk(cls.__table__.insert(), rows)
+        cls._record_bulk(rows, 'insert')
+
+    @classmethod
+    def bulk_update(cls, rows):
+        """Update the columns in ``rows`` of the rows of their primary key,
+        with executemany.
+        """
+        table = cls.__table__
+        pks = [column.key for column in cls.__mapper__.primary_key]
+        #: a row of only the primary key has nothing to set
+        rows = [row for row in rows if set(row).difference(pks)]
+        groups = {}
+        for row in rows:
+            groups.setdefault(frozenset(row), []).append(row)
+        for keys, group in groups.iteritems():
+            #: names of the column would clash with the SET clause
+            statement = table.update().where(sqlalchemy.and_(*[
+                table.c[key] == bindparam('_' + key) for key in pks])) \
+                .values(dict((key, bindparam('_' + key))
+                             for key in keys if key not in pks))
+            cls._execute_bulk(statement, [
+                dict(('_' + key, value) for key, value in row.iteritems())
+                for row in group], multivalues=False)
+        cls._record_bulk(rows, 'update')
+
+    @classmethod
+    def bulk_upsert(cls, rows, conflict_cols, update_cols=None):
+        """Insert ``rows``, or update ``update_cols`` of the rows which
+        conflict on ``conflict_cols``.  ``update_cols`` defaults to the
+        other columns of the rows, ``()`` skips the conflicting rows.
+
+        It is ``ON DUPLICATE KEY UPDATE`` on MySQL, ``ON CONFLICT`` on
+        PostgreSQL and SQLite 3.24+.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        conflict_cols = list(conflict_cols)
+        if update_cols is None:
+            update_cols = [key for key in rows[0] if key not in conflict_cols]
+        statement = _Upsert(cls.__table__, conflict_cols, list(update_cols))
+        cls._execute_bulk(statement, rows)
+        cls._record_bulk(rows, 'upsert')
+
 
 class SQLAlchemy(object):
     """
@@ -458,7 +1223,8 @@ class SQLAlchemy(object):
 
     """
     def __init__(self, engine_url, echo=False, pool_recycle=3600,
-                 pool_size=10, session_extensions=None, session_options=None):
+                 pool_size=10, session_extensions=None, session_options=None,
+                 binds=None, replicas=None):
         # create signals sender
         self.sender = str(uuid.uuid4())
 
@@ -467,17 +1233,70 @@ class SQLAlchemy(object):
         self.session = self.create_scoped_session(session_options)
         self.Model = self.make_declarative_base()
 
-        if engine_url.startswith('sqlite'):
-            self.engine = sqlalchemy.create_engine(engine_url, echo=echo)
-        else:
-            self.engine = sqlalchemy.create_engine(
-                engine_url, echo=echo, pool_recycle=pool_recycle,
-                pool_size=pool_size,
-                isolation_level="READ COMMITTED"
-            )
+        self.echo = echo
+        self.pool_recycle = pool_recycle
+        self.pool_size = pool_size
+        self.engine = self.create_engine(engine_url)
+
+        #: bind key -> engine, and bind key -> replica engines, the key of
+        #: the default engine is ``None``
+        self.binds = {}
+        self.replicas = {None: [self.create_engine(url)
+                                for url in to_list(replicas, [])]}
+        for key, bind in (binds or {}).iteritems():
+            if isinstance(bind, basestring):
+                bind = {'url': bind}
+            self.binds[key] = self.create_engine(bind['url'])
+            self.replicas[key] = [self.create_engine(url)
+                                  for url in bind.get('replicas', [])]
 
         _include_sqlalchemy(self)
 
+    def create_engine(self, engine_url):
+        if engine_url.startswith('sqlite'):
+            return sqlalchemy.create_engine(engine_url, echo=self.echo)
+        return sqlalchemy.create_engine(
+            engine_url, echo=self.echo, pool_recycle=self.pool_recycle,
+            pool_size=self.pool_size,
+            isolation_level="READ COMMITTED"
+        )
+
+    def get_engine(self, bind_key=None):
+        """The engine of ``bind_key``, the default engine of ``None``."""
+        if bind_key is None:
+            return self.engine
+        try:
+            return self.binds[bind_key]
+        except KeyError:
+            raise KeyError('bind %r is not configured in sqlalchemy_binds'
+                           % bind_key)
+
+    def get_replica(self, bind_key=None):
+        """A random replica engine of ``bind_key``, ``None`` if it has no
+        replicas.
+        """
+        replicas = self.replicas.get(bind_key)
+        if replicas:
+            return random.choice(replicas)
+        return None
+
+    def begin_request(self):
+        """Called when a request starts.  The requests of the ioloop
+        share the session of its thread, a request which has written must
+        read from the primary until it finishes, even while the others
+        finish before it.
+        """
+        self.session()._requests += 1
+
+    def end_request(self):
+        """Called when a request finishes, the reads go to the replicas
+        again once no request is in flight.
+        """
+        session = self.session()
+        session._requests = max(session._requests - 1, 0)
+        if not session._requests:
+            session._use_primary = False
+
     def create_scoped_session(self, options=None):
         """Helper factory method that creates a scoped session."""
         if options is None:
@@ -492,13 +1311,21 @@ class SQLAlchemy(object):
         base.query = _QueryProperty(self)
         return base
 
+    def _tables_of(self, bind_key):
+        return [table for table in self.Model.metadata.sorted_tables
+                if table.info.get('bind_key') == bind_key]
+
     def create_all(self):
         """Creates all tables."""
-        self.Model.metadata.create_all(bind=self.engine)
+        for key in [None] + list(self.binds):
+            self.Model.metadata.create_all(bind=self.get_engine(key),
+                                           tables=self._tables_of(key))
 
     def drop_all(self):
         """Drops all tables."""
-        self.Model.metadata.drop_all(bind=self.engine)
+        for key in [None] + list(self.binds):
+            self.Model.metadata.drop_all(bind=self.get_engine(key),
+                                         tables=self._tables_of(key))
 
     @classmethod
     def create_instance(cls, engine_url, kwargs=None):
@@ -526,6 +1353,21 @@ class SQLAlchemy(object):
 set_default_option('sqlalchemy_engine', type=str, help='databse engine')
 set_default_option('sqlalchemy_kwargs', default={},
                    type=dict, help='sqlalchemy extra params')
+set_default_option('sqlalchemy_binds', default={}, type=dict,
+                   help='engines of the models with a __bind_key__, bind '
+                        'key to url or to {"url": ..., "replicas": [...]}')
+set_default_option('sqlalchemy_bulk_chunk_size', default=1000, type=int,
+                   help='rows per statement of the bulk model methods')
+set_default_option('sqlalchemy_replicas', default=[], type=str,
+                   multiple=True,
+                   help='replica urls of sqlalchemy_engine, for reads')
+set_default_option('paginate_count', default='exact', type=str,
+                   help='how paginate counts the total: exact, cached, '
+                        'estimate or window')
+set_default_option('paginate_count_ttl', default=60, type=int,
+                   help='seconds a cached pagination total is kept')
+set_default_option('paginate_estimate_threshold', default=10000, type=int,
+                   help='smallest pagination total which is estimated')
 
 db = SQLAlchemy.create_instance(
     #: string like
@@ -534,5 +1376,6 @@ db = SQLAlchemy.create_instance(
 
     #: dictionary like
     #: {'pool_recycle': 3600}
-    options.sqlalchemy_kwargs,
+    dict(options.sqlalchemy_kwargs, binds=options.sqlalchemy_binds,
+         replicas=options.sqlalchemy_replicas),
 )
@@ -0,0 +1,128 @@
+"""Request scoped batching of cache and model lookups.
+
+A handler asks for what it needs, and the lookups of one IOLoop tick are
+resolved together::
+
+    class TopicHandler(DojangHandler):
+        @gen.coroutine
+        def get(self):
+            topics = Topic.query.limit(20).all()
+            users = yield [self.loader.load(User, t.user_id, 'users')
+                           for t in topics]
+
+Templates which can not yield batch their loops with :meth:`load_many`.
+"""
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.options import options
+
+from .cache import complex_cache, get_cache_list
+
+
+__all__ = ['DataLoader']
+
+
+class DataLoader(object):
+    """Collects the lookups made during one IOLoop tick, and resolves them
+    with one ``mget`` for the cache keys, and one :func:`get_cache_list`
+    (``hmget`` plus ``IN`` query) or one ``IN`` query per model.  Results
+    are memoized for the life of the loader, which is one request.
+    """
+    def __init__(self):
+        self._memo = {}
+        self._keys = {}
+        self._ids = {}
+        self._scheduled = False
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            IOLoop.current().add_callback(self.dispatch)
+
+    def load(self, model, id, key_hash=None):
+        """Future of the ``model`` instance of ``id``, ``None`` when it does
+        not exist.  With ``key_hash`` it is read through
+        :func:`get_cache_list`.
+        """
+        future = Future()
+        memo_key = (model, str(id))
+        if memo_key in self._memo:
+            future.set_result(self._memo[memo_key])
+            return future
+        pending = self._ids.setdefault((model, key_hash), {})
+        pending.setdefault(str(id), []).append(future)
+        self._schedule()
+        return future
+
+    def load_key(self, key):
+        """Future of the value of ``key``, like :func:`autocache_get`."""
+        future = Future()
+        if ('key', key) in self._memo:
+            future.set_result(self._memo[('key', key)])
+            return future
+        self._keys.setdefault(key, []).append(future)
+        self._schedule()
+        return future
+
+    def load_many(self, model, id_list, key_hash=None):
+        """The ``model`` instances of ``id_list`` in order, missing ones are
+        skipped.  Only ids which are not memoized yet are fetched.
+        """
+        missing = [id for id in id_list if (model, str(id)) not in self._memo]
+        if missing:
+            self._fetch(model, key_hash, missing)
+        items = [self._memo.get((model, str(id))) for id in id_list]
+        return [item for item in items if item is not None]
+
+    def load_keys(self, keys):
+        """The values of ``keys`` in order, like :func:`autocache_mget`
+        with the site prefix.
+        """
+        missing = [key for key in keys if ('key', key) not in self._memo]
+        if missing:
+            self._fetch_keys(missing)
+        return [self._memo[('key', key)] for key in keys]
+
+    def _fetch(self, model, key_hash, id_list):
+        if key_hash is None:
+            items = model.query.filter_by(id__in=set(id_list)).all()
+        else:
+            items = get_cache_list(model, id_list, key_hash).values()
+        for id in id_list:
+            self._memo[(model, str(id))] = None
+        for item in items:
+            self._memo[(model, str(item.id))] = item
+
+    def _fetch_keys(self, keys):
+        prefix = options.site_cache_prefix
+        values = complex_cache.mget([prefix + key for key in keys])
+        for key, value in zip(keys, values):
+            self._memo[('key', key)] = value
+
+    def dispatch(self):
+        """Resolve the pending lookups now."""
+        self._scheduled = False
+        keys, self._keys = self._keys, {}
+        ids, self._ids = self._ids, {}
+
+        if keys:
+            self._resolve(keys, lambda: self._fetch_keys(list(keys)),
+                          lambda key: ('key', key))
+        for (model, key_hash), pending in ids.iteritems():
+            self._resolve(
+                pending, lambda: self._fetch(model, key_hash, list(pending)),
+                lambda id: (model, id))
+
+    def _resolve(self, pending, fetch, memo_key):
+        try:
+            fetch()
+        except Exception as e:
+            for futures in pending.itervalues():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for name, futures in pending.iteritems():
+            value = self._memo.get(memo_key(name))
+            for future in futures:
+                future.set_result(value)
@@ -0,0 +1,139 @@
+"""Compact serializers for cached values.
+
+A serialized value starts with a header byte, its low bits are the format
+and ``COMPRESSED`` marks a zlib compressed payload.  Data without a known
+header is read as a legacy ``cPickle`` string, so old and new entries can
+be mixed during a rollout::
+
+    data = dumps(value, 'json')
+    value = loads(data)
+"""
+
+import cPickle
+import json
+import zlib
+
+from tornado.options import options
+
+from .util import set_default_option
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ['Serializer', 'PickleSerializer', 'JSONSerializer',
+           'MsgpackSerializer', 'get_serializer', 'dumps', 'loads']
+
+
+set_default_option('cache_serializer', default='pickle', type=str,
+                   help='default serializer of cached values')
+set_default_option('cache_compress_threshold', default=1024, type=int,
+                   help='compress serialized values larger than this, '
+                        '0 to disable')
+
+
+COMPRESSED = 0x10
+
+
+class Serializer(object):
+    #: header format id, must be unique and below 0x10
+    format = None
+    name = None
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(Serializer):
+    format = 1
+    name = 'pickle'
+
+    def dumps(self, value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class JSONSerializer(Serializer):
+    format = 2
+    name = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    format = 3
+    name = 'msgpack'
+
+    def dumps(self, value):
+        if msgpack is None:
+            raise RuntimeError('msgpack serializer is unavailable because '
+                               'the msgpack library is not installed.')
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        if msgpack is None:
+            raise RuntimeError('msgpack serializer is unavailable because '
+                               'the msgpack library is not installed.')
+        return msgpack.unpackb(data, raw=False)
+
+
+_serializers = {}
+
+
+def register_serializer(serializer):
+    _serializers[serializer.format] = serializer
+    _serializers[serializer.name] = serializer
+
+
+for _serializer in (PickleSerializer(), JSONSerializer(), MsgpackSerializer()):
+    register_serializer(_serializer)
+
+
+def get_serializer(name=None):
+    if name is None:
+        name = options.cache_serializer
+    if isinstance(name, Serializer):
+        return name
+    return _serializers[name]
+
+
+def dumps(value, serializer=None, threshold=None):
+    """Serialize ``value`` with a header byte, payloads larger than
+    ``threshold`` bytes are compressed when that makes them smaller.
+    """
+    serializer = get_serializer(serializer)
+    if threshold is None:
+        threshold = options.cache_compress_threshold
+    data = serializer.dumps(value)
+    header = serializer.format
+    if threshold and len(data) > threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+            header |= COMPRESSED
+    return chr(header) + data
+
+
+def loads(data):
+    if not data:
+        return data
+    header = ord(data[0])
+    serializer = _serializers.get(header & ~COMPRESSED)
+    if serializer is None:
+        #: written before the serializers, a plain pickle
+        return cPickle.loads(data)
+    data = data[1:]
+    if header & COMPRESSED:
+        data = zlib.decompress(data)
+    return serializer.loads(data)
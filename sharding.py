@@ -0,0 +1,249 @@
+"""Client side sharding of redis over several nodes.
+
+Keys are spread with a ketama consistent hash ring, so adding a node only
+moves about ``1/N`` of the keys.  A key containing ``{tag}`` is placed by
+the tag only, like redis cluster does, to keep related keys together::
+
+    options.redis_clients = [
+        {'host': '10.0.0.1', 'port': 6379},
+        {'host': '10.0.0.2', 'port': 6379, 'weight': 2},
+    ]
+"""
+
+import bisect
+import hashlib
+import struct
+import threading
+
+
+__all__ = ['HashRing', 'ShardedRedis']
+
+
+#: points of a node with weight 1 on the ring, 4 points per md5 digest
+POINTS = 160
+
+
+def _hash_tag(key):
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing(object):
+    """Ketama consistent hash ring of ``{name: weight}``."""
+
+    def __init__(self, weights):
+        ring = []
+        for name, weight in weights.iteritems():
+            for i in xrange(POINTS * weight / 4):
+                digest = hashlib.md5('%s-%d' % (name, i)).digest()
+                for point in struct.unpack('<4I', digest):
+                    ring.append((point, name))
+        ring.sort()
+        self._points = [point for point, name in ring]
+        self._names = [name for point, name in ring]
+
+    def get_name(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        point = struct.unpack('<I', hashlib.md5(_hash_tag(str(key)))
+                              .digest()[:4])[0]
+        index = bisect.bisect(self._points, point)
+        if index == len(self._points):
+            index = 0
+        return self._names[index]
+
+
+def _parallel(calls):
+    """Run ``(func, args)`` calls in threads, returns the results in order.
+    """
+    if len(calls) == 1:
+        func, args = calls[0]
+        return [func(*args)]
+    results = [None] * len(calls)
+    errors = []
+
+    def run(i, func, args):
+        try:
+            results[i] = func(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i, func, args))
+               for i, (func, args) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class ShardedRedis(object):
+    """redis-py compatable client over ``{name: (client, weight)}``.
+
+    Single key commands go to the node of their key, the multi key
+    commands fan out to the nodes in parallel.  Pub/sub uses the first
+    node of the sorted names, so every process meets on the same one.
+    """
+    def __init__(self, nodes):
+        self.nodes = dict((name, client)
+                          for name, (client, weight) in nodes.iteritems())
+        self.ring = HashRing(dict((name, weight)
+                                  for name, (client, weight) in nodes.iteritems()))
+        self.pubsub_node = self.nodes[sorted(self.nodes)[0]]
+
+    @classmethod
+    def from_options(cls, clients, factory):
+        """Build from a list of ``{'host', 'port', 'name', 'weight'}``,
+        ``factory(host, port, options)`` creates the client of a node.
+        """
+        nodes = {}
+        for node in clients:
+            name = node.get('name') or '%s:%s' % (node['host'], node['port'])
+            nodes[name] = (factory(node['host'], node['port'], node),
+                           node.get('weight', 1))
+        return cls(nodes)
+
+    def get_node(self, key):
+        return self.nodes[self.ring.get_name(key)]
+
+    def _group(self, keys):
+        """Returns ``{name: [(index, key), ...]}`` of ``keys``."""
+        groups = {}
+        for index, key in enumerate(keys):
+            groups.setdefault(self.ring.get_name(key), []).append((index, key))
+        return groups
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            return getattr(self.get_node(key), name)(key, *args, **kwargs)
+        command.__name__ = name
+        return command
+
+    def mget(self, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        keys = list(keys) + list(args)
+        groups = self._group(keys)
+        names = list(groups)
+        replies = _parallel([
+            (self.nodes[name].mget, ([key for i, key in groups[name]],))
+            for name in names])
+        values = [None] * len(keys)
+        for name, reply in zip(names, replies):
+            for (index, key), value in zip(groups[name], reply):
+                values[index] = value
+        return values
+
+    def delete(self, *names):
+        groups = self._group(names)
+        replies = _parallel([
+            (self.nodes[name].delete, [key for i, key in group])
+            for name, group in groups.iteritems()])
+        return sum(reply or 0 for reply in replies)
+
+    def keys(self, pattern='*'):
+        replies = _parallel([(node.keys, (pattern,))
+                             for node in self.nodes.itervalues()])
+        return [key for reply in replies for key in reply]
+
+    def scan_iter(self, match=None, count=None):
+        for node in self.nodes.itervalues():
+            for key in node.scan_iter(match=match, count=count):
+                yield key
+
+    def flushdb(self):
+        return all(_parallel([(node.flushdb, ())
+                              for node in self.nodes.itervalues()]))
+
+    def publish(self, channel, message):
+        return self.pubsub_node.publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.pubsub_node.pubsub(**kwargs)
+
+    def pipeline(self, transaction=False):
+        return ShardedPipeline(self)
+
+
+class ShardedPipeline(object):
+    """Queues commands per node, :meth:`execute` runs the pipelines of all
+    the nodes in parallel and returns the replies in the order of the
+    commands.  Commands are routed by their first argument, the multi key
+    ones are split over the nodes of their keys.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.pipes = {}
+        #: (names of the nodes, merge of their replies) of each command
+        self.order = []
+
+    def _pipe(self, name):
+        pipe = self.pipes.get(name)
+        if pipe is None:
+            pipe = self.pipes[name] = \
+                self.client.nodes[name].pipeline(transaction=False)
+        return pipe
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            node = self.client.ring.get_name(key)
+            getattr(self._pipe(node), name)(key, *args, **kwargs)
+            self.order.append(([node], None))
+            return self
+        return command
+
+    def delete(self, *names):
+        groups = self.client._group(names)
+        for node, group in groups.iteritems():
+            self._pipe(node).delete(*[key for i, key in group])
+        self.order.append((list(groups),
+                           lambda replies: sum(r or 0 for r in replies)))
+        return self
+
+    def mget(self, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        keys = list(keys) + list(args)
+        groups = self.client._group(keys)
+        for node, group in groups.iteritems():
+            self._pipe(node).mget([key for i, key in group])
+
+        def merge(replies):
+            values = [None] * len(keys)
+            for group, reply in zip(groups.itervalues(), replies):
+                for (index, key), value in zip(group, reply):
+                    values[index] = value
+            return values
+        self.order.append((list(groups), merge))
+        return self
+
+    def execute(self):
+        pipes, self.pipes = self.pipes, {}
+        order, self.order = self.order, []
+        names = list(pipes)
+        replies = dict(zip(names, _parallel([(pipes[name].execute, ())
+                                             for name in names])))
+        positions = dict((name, 0) for name in names)
+        results = []
+        for nodes, merge in order:
+            node_replies = []
+            for name in nodes:
+                node_replies.append(replies[name][positions[name]])
+                positions[name] += 1
+            if merge is None:
+                results.append(node_replies[0])
+            else:
+                results.append(merge(node_replies))
+        return results
@@ -0,0 +1,302 @@
+"""python-memcache compatable cache in a shared memory file.
+
+All the processes of a host which open the same file share the cache, no
+server is needed.  The file is a fixed size hash table::
+
+    header | slot | slot | ...
+
+Each slot holds one item: a slot header, the key and the value.  An item
+is stored in one of ``PROBE`` slots after the slot its key hashes to, an
+empty or expired slot is used first, otherwise the least recently used
+slot of them is evicted.  Items larger than a slot are not stored, like
+memcached does with items larger than its item size.
+"""
+
+import cPickle
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+from time import time as sys_time
+
+from tornado.options import options
+
+from .util import set_default_option
+
+
+__all__ = ['SharedMemoryCache']
+
+
+set_default_option('cache_shm_path', default='', type=str,
+                   help='file of the shared memory cache, used by '
+                        'simple_cache when memcache is not configured')
+set_default_option('cache_shm_slots', default=65536, type=int,
+                   help='number of slots of the shared memory cache')
+set_default_option('cache_shm_slot_size', default=1024, type=int,
+                   help='bytes of a slot of the shared memory cache')
+
+
+#: magic, slots, slot size, hits, misses, evictions
+_HEADER = struct.Struct('<8sIIQQQ')
+_HEADER_SIZE = 64
+_MAGIC = 'DJSHM001'
+
+#: state, flags, key length, value length, key hash, expires, access time
+_SLOT = struct.Struct('<BBHIQdd')
+
+_EMPTY = 0
+_USED = 1
+
+_FLAG_PICKLE = 1
+
+PROBE = 8
+
+
+def _hash(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class SharedMemoryCache(object):
+
+    def __init__(self, path, slots=65536, slot_size=1024):
+        if slot_size <= _SLOT.size:
+            raise ValueError('slot size must be larger than %d' % _SLOT.size)
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.size = _HEADER_SIZE + slots * slot_size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._lock()
+        try:
+            if os.fstat(self._fd).st_size != self.size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+            self._map = mmap.mmap(self._fd, self.size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            magic, _slots, _slot_size = _HEADER.unpack_from(self._map, 0)[:3]
+            if (magic, _slots, _slot_size) != (_MAGIC, slots, slot_size):
+                self._map[:self.size] = '\0' * self.size
+                _HEADER.pack_into(self._map, 0, _MAGIC, slots, slot_size,
+                                  0, 0, 0)
+        finally:
+            self._unlock()
+
+    @classmethod
+    def create(cls):
+        return cls(options.cache_shm_path, slots=options.cache_shm_slots,
+                   slot_size=options.cache_shm_slot_size)
+
+    def _lock(self):
+        #: posix record locks belong to a process, so they also exclude
+        #: the forked workers which inherited the file
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _count(self, field):
+        #: field is 3 (hits), 4 (misses) or 5 (evictions) of the header
+        values = list(_HEADER.unpack_from(self._map, 0))
+        values[field] += 1
+        _HEADER.pack_into(self._map, 0, *values)
+
+    def _offset(self, index):
+        return _HEADER_SIZE + (index % self.slots) * self.slot_size
+
+    def _find(self, key, key_hash):
+        """Returns the offset of the slot of ``key``, or ``None``."""
+        start = key_hash % self.slots
+        for i in xrange(PROBE):
+            offset = self._offset(start + i)
+            state, flags, klen, vlen, h, expires, atime = \
+                _SLOT.unpack_from(self._map, offset)
+            if state == _USED and h == key_hash:
+                begin = offset + _SLOT.size
+                if self._map[begin:begin + klen] == key:
+                    return offset
+        return None
+
+    def _read(self, offset, now):
+        """Returns the value of the slot at ``offset``, ``None`` if it has
+        expired.
+        """
+        state, flags, klen, vlen, h, expires, atime = \
+            _SLOT.unpack_from(self._map, offset)
+        if expires and now > expires:
+            self._map[offset] = chr(_EMPTY)
+            return None
+        _SLOT.pack_into(self._map, offset, state, flags, klen, vlen, h,
+                        expires, now)
+        begin = offset + _SLOT.size + klen
+        data = self._map[begin:begin + vlen]
+        if flags & _FLAG_PICKLE:
+            return cPickle.loads(data)
+        return data
+
+    def _get(self, key, now):
+        offset = self._find(key, _hash(key))
+        if offset is None:
+            return None
+        return self._read(offset, now)
+
+    def _write(self, key, val, time, now):
+        if isinstance(val, str):
+            flags, data = 0, val
+        else:
+            flags = _FLAG_PICKLE
+            data = cPickle.dumps(val, cPickle.HIGHEST_PROTOCOL)
+        if _SLOT.size + len(key) + len(data) > self.slot_size:
+            return False
+
+        key_hash = _hash(key)
+        offset = self._find(key, key_hash)
+        if offset is None:
+            offset = self._free_slot(key_hash, now)
+        expires = now + time if time else 0
+        _SLOT.pack_into(self._map, offset, _USED, flags, len(key), len(data),
+                        key_hash, expires, now)
+        begin = offset + _SLOT.size
+        self._map[begin:begin + len(key) + len(data)] = key + data
+        return True
+
+    def _free_slot(self, key_hash, now):
+        start = key_hash % self.slots
+        victim = None
+        oldest = None
+        for i in xrange(PROBE):
+            offset = self._offset(start + i)
+            state, flags, klen, vlen, h, expires, atime = \
+                _SLOT.unpack_from(self._map, offset)
+            if state == _EMPTY or (expires and now > expires):
+                return offset
+            if oldest is None or atime < oldest:
+                victim, oldest = offset, atime
+        self._count(5)
+        return victim
+
+    def get(self, key):
+        key = str(key)
+        self._lock()
+        try:
+            value = self._get(key, sys_time())
+            self._count(4 if value is None else 3)
+            return value
+        finally:
+            self._unlock()
+
+    def set(self, key, val, time=0):
+        key = str(key)
+        if time < 0:
+            time = 0
+        self._lock()
+        try:
+            return self._write(key, val, time, sys_time())
+        finally:
+            self._unlock()
+
+    def add(self, key, val, time=0):
+        key = str(key)
+        self._lock()
+        try:
+            now = sys_time()
+            if self._get(key, now) is not None:
+                return False
+            return self._write(key, val, time, now)
+        finally:
+            self._unlock()
+
+    def delete(self, key, time=0):
+        key = str(key)
+        self._lock()
+        try:
+            offset = self._find(key, _hash(key))
+            if offset is not None:
+                self._map[offset] = chr(_EMPTY)
+        finally:
+            self._unlock()
+        return None
+
+    def incr(self, key, delta=1):
+        key = str(key)
+        self._lock()
+        try:
+            now = sys_time()
+            offset = self._find(key, _hash(key))
+            if offset is None:
+                return None
+            value = self._read(offset, now)
+            if value is None:
+                return None
+            expires = _SLOT.unpack_from(self._map, offset)[5]
+            value = int(value) + delta
+            self._write(key, value, expires and expires - now, now)
+            return value
+        finally:
+            self._unlock()
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+    def set_multi(self, mapping, time=0, key_prefix=''):
+        for key, value in mapping.items():
+            self.set('%s%s' % (key_prefix, key), value, time)
+
+        return True
+
+    def get_multi(self, keys, key_prefix=''):
+        dct = {}
+        for key in keys:
+            value = self.get('%s%s' % (key_prefix, key))
+            if value:
+                dct[key] = value
+
+        return dct
+
+    def delete_multi(self, keys, time=0, key_prefix=''):
+        for key in keys:
+            self.delete('%s%s' % (key_prefix, key))
+
+        return None
+
+    def mget(self, keys):
+        """redis compatable multi get"""
+        return [self.get(key) for key in keys]
+
+    def flush_all(self):
+        self._lock()
+        try:
+            hits, misses, evictions = _HEADER.unpack_from(self._map, 0)[3:]
+            self._map[:self.size] = '\0' * self.size
+            _HEADER.pack_into(self._map, 0, _MAGIC, self.slots,
+                              self.slot_size, hits, misses, evictions)
+        finally:
+            self._unlock()
+
+    def get_stats(self):
+        """python-memcache compatable stats, counter names follow memcached.
+        """
+        self._lock()
+        try:
+            hits, misses, evictions = _HEADER.unpack_from(self._map, 0)[3:]
+            now = sys_time()
+            items = 0
+            for index in xrange(self.slots):
+                offset = self._offset(index)
+                if ord(self._map[offset]) != _USED:
+                    continue
+                expires = _SLOT.unpack_from(self._map, offset)[5]
+                if not expires or now <= expires:
+                    items += 1
+        finally:
+            self._unlock()
+        stats = {
+            'curr_items': items,
+            'limit_maxitems': self.slots,
+            'limit_maxbytes': self.size,
+            'get_hits': hits,
+            'get_misses': misses,
+            'evictions': evictions,
+        }
+        return [(self.path, stats)]
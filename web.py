@@ -1,4 +1,5 @@
 import re
+import sys
 
 import oauth 
 from sqlalchemy.exc import SQLAlchemyError
@@ -23,7 +24,31 @@ def ignore_user_agent(user_agent):
 
 
 
-class DojangHandler(web.RequestHandler):
+def _database():
+    #: only when the application uses the database, importing it creates
+    #: the engine
+    return sys.modules.get(__name__.rsplit('.', 1)[0] + '.database')
+
+
+class _DatabaseRequestMixin(object):
+    """Tells :mod:`dojang.database` which requests are in flight, the
+    reads go to the primary until the requests which have written finish.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_DatabaseRequestMixin, self).__init__(*args, **kwargs)
+        database = _database()
+        self._database_request = database is not None
+        if self._database_request:
+            database.db.begin_request()
+
+    def on_finish(self):
+        if self._database_request:
+            self._database_request = False
+            _database().db.end_request()
+
+
+class DojangHandler(_DatabaseRequestMixin, web.RequestHandler):
     messages = []
 
     def messages(self):
@@ -89,6 +114,15 @@ class DojangHandler(web.RequestHandler):
     def get_user_locale(self):
         return locale.get('zh_CN')
 
+    @property
+    def loader(self):
+        """Request scoped :class:`~dojang.loader.DataLoader`, it batches and
+        memoizes the cache and model lookups of this request.
+        """
+        if getattr(self, '_loader', None) is None:
+            from .loader import DataLoader
+            self._loader = DataLoader()
+        return self._loader
 
     def is_mobile(self):
         if 'User-Agent' in self.request.headers:
@@ -161,7 +195,27 @@ class DojangHandler(web.RequestHandler):
                 pass
         super(DojangHandler, self)._handle_request_exception(e)
 
-class ApiHandler(web.RequestHandler):
+class CacheStatsHandler(web.RequestHandler):
+    """Serve the cache statistics as JSON to ``cache_stats_ips``, see
+    :meth:`DojangApplication.register_cache_stats`.
+
+    ``remote_ip`` comes from ``X-Real-Ip`` with ``xheaders``, anyone can
+    send it.  The address of the socket must be allowed too, it is the
+    proxy behind a proxy, and the proxy sets the header.
+    """
+    def get(self):
+        context = getattr(self.request.connection, 'context', None)
+        address = getattr(context, 'address', None)
+        peer = address[0] if isinstance(address, tuple) else None
+        allowed = options.cache_stats_ips
+        if peer not in allowed or self.request.remote_ip not in allowed:
+            raise web.HTTPError(403)
+        from .cache import get_cache_stats
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(escape.json_encode(get_cache_stats()))
+
+
+class ApiHandler(_DatabaseRequestMixin, web.RequestHandler):
     xsrf_protect = False
 
     def check_xsrf_cookie(self):
@@ -268,6 +322,7 @@ def init_options():
 
 def run_server(app):
     import logging
+    import signal
     import tornado.locale
     from tornado import httpserver, ioloop
     from tornado.options import options
@@ -279,8 +334,32 @@ def run_server(app):
         tornado.locale.load_translations(options.locale_path)
         tornado.locale.set_default_locale(options.default_locale)
 
+    from .cache import (restore_cache_snapshot, save_cache_snapshot,
+                        start_cache_tasks)
+    from .counter import counters
+    restore_cache_snapshot()
+    start_cache_tasks()
+
+    io_loop = ioloop.IOLoop.instance()
+
+    def shutdown(signum):
+        logging.info('Stop server on signal %d' % signum)
+        server.stop()
+        io_loop.stop()
+
+    def on_signal(signum, frame):
+        #: a deploy sends SIGTERM, flush the counters and the snapshot first
+        io_loop.add_callback_from_signal(shutdown, signum)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
     logging.info('Start server at %s:%s' % (options.address, options.port))
-    ioloop.IOLoop.instance().start()
+    try:
+        io_loop.start()
+    finally:
+        counters.flush()
+        save_cache_snapshot()
 
 
 set_default_option('address', default='127.0.0.1', type=str,
@@ -294,3 +373,5 @@ set_default_option('settings', default='', type=str,
 set_default_option('locale_path', type=str,
                    help='absolute path of locale directory')
 set_default_option('default_locale', default='en_US', type=str)
+set_default_option('cache_stats_ips', default=['127.0.0.1', '::1'], type=str,
+                   multiple=True, help='addresses allowed to read cache stats')